@@ -0,0 +1,154 @@
+import os
+import numpy as np
+
+# ================== IVF (INVERTED FILE) INDEX ==================
+class IvfIndex:
+    """
+    Approximate nearest neighbour index over unit vectors (pure NumPy).
+    The vectors are clustered with spherical k-means & a query only scores the rows of the
+    `nprobe` closest clusters. More probes means better recall but slower search.
+    The index only keeps the cluster of every row, the vectors stay in the caller's matrix.
+    """
+
+    def __init__(self, index_path, nprobe=8, n_iter=10, seed=0) -> None:
+        self.index_path = index_path
+        self.nprobe = nprobe
+        self.n_iter = n_iter
+        self.seed = seed
+        self.centroids = None # (nlist, dim)
+        self.row_ids = np.zeros(0, dtype=np.int64) # library row ids, sorted
+        self.assign = np.zeros(0, dtype=np.int32) # cluster of every row
+        self.trained_rows = 0
+        self.lists = None # (order, offsets) of the inverted lists
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    # ================== TRAINING ==================
+    def train(self, row_ids, matrix, nlist=None):
+        num_rows = len(row_ids)
+        if nlist is None:
+            nlist = int(np.sqrt(num_rows))
+        nlist = max(1, min(nlist, 1024, num_rows))
+        rng = np.random.default_rng(self.seed)
+        # k-means on a sample is enough for the centroids
+        sample_size = min(num_rows, nlist * 256)
+        sample = matrix[rng.choice(num_rows, sample_size, replace=False)] if sample_size < num_rows else matrix
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(self.n_iter):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=nlist)
+            empty = counts == 0
+            if empty.any(): # re-seed the empty clusters with random points
+                sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            centroids = sums / np.clip(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12, None)
+        self.centroids = centroids.astype(np.float32)
+        self.row_ids = np.asarray(row_ids, dtype=np.int64)
+        self.assign = self.nearest_centroid(matrix)
+        self.trained_rows = num_rows
+        self.lists = None
+        print(f"Trained IVF index: {nlist} lists over {num_rows} rows")
+
+    def nearest_centroid(self, vectors, batch=8192):
+        out = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), batch):
+            out[start:start + batch] = np.argmax(vectors[start:start + batch] @ self.centroids.T, axis=1)
+        return out
+
+    # ================== INCREMENTAL UPDATES ==================
+    def sync(self, row_ids, matrix, min_rows=20000, retrain_factor=4):
+        """
+        Brings the index in line with the library matrix (rows sorted by id): removed rows are dropped &
+        new rows get assigned to their closest cluster. It (re)trains when the library is big enough or has
+        grown `retrain_factor` times since the last training. Returns True if the index changed.
+        """
+        if not self.is_trained:
+            self.load()
+        num_rows = len(row_ids)
+        if num_rows < min_rows:
+            return False
+        stale = self.is_trained and self.centroids.shape[1] != matrix.shape[1] # another embed model
+        if not self.is_trained or stale or num_rows >= self.trained_rows * retrain_factor:
+            self.train(row_ids, matrix)
+            self.save()
+            return True
+        if len(self.row_ids) == num_rows and np.array_equal(self.row_ids, row_ids):
+            return False
+        keep = np.isin(self.row_ids, row_ids, assume_unique=True)
+        new_pos = np.flatnonzero(~np.isin(row_ids, self.row_ids, assume_unique=True))
+        row_ids_all = np.concatenate([self.row_ids[keep], row_ids[new_pos]])
+        assign_all = np.concatenate([self.assign[keep], self.nearest_centroid(matrix[new_pos])])
+        order = np.argsort(row_ids_all, kind="stable")
+        self.row_ids = row_ids_all[order]
+        self.assign = assign_all[order]
+        self.lists = None
+        self.save()
+        return True
+
+    # ================== SEARCH ==================
+    def build_lists(self):
+        order = np.argsort(self.assign, kind="stable").astype(np.int64)
+        counts = np.bincount(self.assign, minlength=len(self.centroids))
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.lists = (order, offsets)
+
+    def candidates(self, query_emb, nprobe=None):
+        """ Matrix positions (sorted) of the rows in the `nprobe` closest clusters of the query """
+        if self.lists is None:
+            self.build_lists()
+        order, offsets = self.lists
+        nprobe = max(1, min(nprobe or self.nprobe, len(self.centroids)))
+        centroid_sims = self.centroids @ query_emb
+        probe = np.argpartition(-centroid_sims, nprobe - 1)[:nprobe]
+        positions = np.concatenate([order[offsets[c]:offsets[c + 1]] for c in probe])
+        positions.sort()
+        return positions
+
+    def search(self, matrix, query_emb, top_k=3, nprobe=None):
+        """ Returns (positions, sims) of the approximate top_k rows of `matrix` """
+        query_emb = np.asarray(query_emb, dtype=np.float32)
+        positions = self.candidates(query_emb, nprobe)
+        sims = matrix[positions] @ query_emb
+        k = min(top_k, len(positions))
+        if k <= 0:
+            return positions[:0], sims[:0]
+        top = np.argpartition(-sims, k - 1)[:k]
+        top = top[np.argsort(-sims[top])]
+        return positions[top], sims[top]
+
+    # ================== PERSISTENCE ==================
+    def save(self):
+        if not self.is_trained:
+            return
+        tmp_path = f"{self.index_path}.tmp.npz"
+        np.savez(
+            tmp_path, centroids=self.centroids, row_ids=self.row_ids,
+            assign=self.assign, trained_rows=np.array([self.trained_rows])
+        )
+        os.replace(tmp_path, self.index_path)
+
+    def load(self):
+        if not os.path.exists(self.index_path):
+            return False
+        try:
+            with np.load(self.index_path) as data:
+                self.centroids = data["centroids"]
+                self.row_ids = data["row_ids"]
+                self.assign = data["assign"]
+                self.trained_rows = int(data["trained_rows"][0])
+            self.lists = None
+            return True
+        except Exception as e:
+            print(f"Could not load the IVF index: {e}")
+            self.reset()
+            return False
+
+    def reset(self):
+        self.centroids = None
+        self.row_ids = np.zeros(0, dtype=np.int64)
+        self.assign = np.zeros(0, dtype=np.int32)
+        self.trained_rows = 0
+        self.lists = None
@@ -0,0 +1,449 @@
+"""
+UI independent chat engine: model loading, chat template, context building & streamed generation.
+The kivy app runs it on its inference worker, it also works headless from the command line:
+
+    cd app
+    python -m chatEngine --model-dir ~/onllm/model_files --model smollm2-360m --prompt "What is ONNX?"
+    python -m chatEngine --model-dir ~/onllm/model_files --model smollm2-360m --doc paper.pdf --prompt "Who are the authors?"
+    python -m chatEngine --model-dir ~/onllm/model_files --model smollm2-360m --batch questions.txt
+"""
+import os
+import sys
+import gc
+import json
+import time
+import argparse
+import platform
+import numpy as np
+from tokenizers import Tokenizer
+
+from llmEngine import Decoder, Sampler, DraftModel, PromptLookup, StreamDetokenizer, ContextBuilder, generate, generate_batch
+from ortSession import resolve_profile, resident_mb, SESSION_POOL
+
+# fixed system prompts, their kv cache is computed once per model (see prepare_kv_snapshots)
+SYSTEM_PROMPTS = {
+    "chat": (
+        "You are a concise and accurate assistant. "
+        "If you are not sure, say you don't know. "
+        "Do not invent facts. "
+        "Use bullet points when helpful."
+    ),
+    "rag": (
+        "Answer ONLY using the provided document context. "
+        "If the answer is not in the context, say: 'Not found in the document.' "
+        "Do not add extra facts."
+    ),
+}
+
+# built-in model, the others come from extra_models.json
+DEFAULT_LLM_MODELS = {
+    "smollm2-135m": {
+        "name": "smollm2-135m",
+        "url": "https://github.com/daslearning-org/OnLLM/releases/download/vOnnxModels/smollm2-135m.tar.gz",
+        "size": "95MB",
+        "platform": "android", # means runs on all
+        "tokens": ["", "<|im_start|>", "<|im_end|>"],
+        "eos_ids": ["<|endoftext|>"],
+        "att_mask": True
+    }
+}
+
+ANDROID_PROVIDERS = [
+    'XnnpackExecutionProvider',
+    'CPUExecutionProvider',
+]
+DESKTOP_PROVIDERS = [
+    'CUDAExecutionProvider',
+    'CPUExecutionProvider'
+]
+
+def default_providers(android=False):
+    """ XNNPACK on android & arm boards, CUDA (if available) then CPU elsewhere """
+    arm_android = False
+    try:
+        cpu_arch = platform.machine()
+        if 'arm' in cpu_arch.lower() or 'aarch' in cpu_arch.lower():
+            arm_android = True
+    except Exception as e:
+        print(f"Error in CPU architecture check: {e}")
+    return ANDROID_PROVIDERS if android or arm_android else DESKTOP_PROVIDERS
+
+def load_model_configs(extra_models_json=None):
+    """ The built-in model & the models of an extra_models.json """
+    llm_models = {name: dict(config) for name, config in DEFAULT_LLM_MODELS.items()}
+    if extra_models_json and os.path.exists(extra_models_json):
+        with open(extra_models_json, "r") as modelfile:
+            llm_models.update(json.load(modelfile))
+    return llm_models
+
+# ================== ENGINE ==================
+class ChatEngine:
+    """
+    Loads a model folder (config.json, tokenizer.json & onnx/model_int8.onnx under `model_dir`) & streams
+    the answers. It has no UI dependency: callers get text pieces from `stream` & decide how to show them.
+    The calls are not thread safe, the app serializes them through its inference worker.
+    """
+
+    def __init__(self, model_dir, llm_models, config_dir=None, seed=None) -> None:
+        self.model_dir = model_dir
+        self.llm_models = llm_models # shared with the caller, new models can be added later
+        self.config_dir = config_dir # kv snapshots are kept there (skipped if None)
+        self.llm = None
+        self.tokenizer = None
+        self.eos_token_ids = []
+        self.session_profile = None
+        self.decoder_session = None
+        self.decoder = None
+        self.decoder_kw = {} # shape of the loaded model, for the batch decoders of chat_batch
+        self.context_builder = None
+        self.seed = seed # fixed seed for the sampler & the draft model sampler (reproducible answers)
+        self.sampler = Sampler(seed)
+        self.drafter = None
+        self.draft_tokens = 4
+        self.prompt_lookup = None
+        self.lookup_tokens = 8
+        self.last_stats = {}
+
+    @property
+    def ready(self):
+        return self.decoder is not None
+
+    # ================== MODEL LOADING ==================
+    def load(self, llm, providers=None):
+        """ Loads `llm` (the previous model is released first) & returns a load report """
+        path_to_model = os.path.join(self.model_dir, llm)
+        load_start = time.perf_counter()
+        rss_before = resident_mb()
+        # drop the references to the previous model, the session pool keeps it loaded only if the budget
+        # allows it next to the new one (otherwise it is freed before the new one loads)
+        self.release()
+        providers = providers or default_providers()
+        model_config = self.llm_models[llm]
+        # Load config & token jsons
+        with open(f"{path_to_model}/config.json", "r") as f:
+            config_data = json.load(f)
+        self.llm = llm
+        self.tokenizer = Tokenizer.from_file(f"{path_to_model}/tokenizer.json")
+        # prompt + answer have to fit in the model context ("max_context" in the model config can lower it)
+        max_context = model_config.get("max_context") or config_data.get("max_position_embeddings", 2048)
+        model_tokens = model_config["tokens"]
+        overhead = len(self.tokenizer.encode(f"{model_tokens[0]}{model_tokens[1]}assistant\n", add_special_tokens=False).ids)
+        self.context_builder = ContextBuilder(self.tokenizer, self.format_message, max_context=int(max_context), overhead=overhead)
+        self.eos_token_ids = [self.tokenizer.token_to_id(model_tokens[2])]
+        for eos in model_config["eos_ids"]:
+            self.eos_token_ids.append(self.tokenizer.token_to_id(str(eos)))
+
+        # threads, graph optimization & memory settings for this device (the model config can override)
+        self.session_profile = resolve_profile(model_config.get("session"))
+        print(f"Session profile: {self.session_profile}")
+        self.decoder_session = SESSION_POOL.get(
+            f"{path_to_model}/onnx/model_int8.onnx", providers, self.session_profile,
+            cache_dir=os.path.join(path_to_model, "cache"),
+        )
+        print("Using:", self.decoder_session.get_providers())
+        self.decoder_kw = {
+            "num_layers": config_data["num_hidden_layers"],
+            "num_kv_heads": config_data["num_key_value_heads"],
+            "head_dim": config_data["head_dim"],
+            "use_att_mask": model_config.get("att_mask", False),
+            "max_len": int(max_context),
+        }
+        # kv cache buffers start small & generate() sizes them for each prompt + answer (kept between turns)
+        decoder = Decoder(self.decoder_session, capacity=128, **self.decoder_kw)
+        self.prepare_kv_snapshots(decoder, path_to_model)
+        self.drafter = self.load_drafter(llm, providers)
+        # prompt lookup drafts from the document context of the RAG answers, no extra model needed
+        lookup = model_config.get("prompt_lookup", {})
+        if lookup is not False:
+            lookup = lookup if isinstance(lookup, dict) else {} # true: the defaults
+            self.prompt_lookup = PromptLookup(ngram=int(lookup.get("ngram", 3)))
+            self.lookup_tokens = int(lookup.get("draft_tokens", 8))
+        self.decoder = decoder
+        # model switch time (the optimized graph is cached in <model>/cache after the first load)
+        load_secs = time.perf_counter() - load_start
+        rss_after = resident_mb()
+        load_msg = f"{llm} ready in {load_secs:.1f}s"
+        if rss_before is not None and rss_after is not None:
+            load_msg += f", RAM {rss_before} MB -> {rss_after} MB"
+        print(load_msg)
+        return load_msg
+
+    def release(self):
+        """ Drops the kv buffers & the references to the sessions, the session pool decides when they are freed """
+        if self.decoder is None and self.decoder_session is None:
+            return
+        self.decoder = None
+        self.decoder_session = None
+        self.drafter = None
+        self.prompt_lookup = None
+        gc.collect()
+        print(f"Released the previous model, RAM {resident_mb()} MB")
+
+    def load_drafter(self, llm, providers):
+        """ Draft model for speculative decoding, from the `speculative` entry of the model config """
+        spec = self.llm_models[llm].get("speculative")
+        if not spec:
+            return None
+        draft_llm = spec.get("draft", "")
+        path_to_draft = os.path.join(self.model_dir, draft_llm)
+        if not os.path.exists(f"{path_to_draft}/onnx/model_int8.onnx"):
+            print(f"Draft model {draft_llm} is not downloaded, speculative decoding is off")
+            return None
+        try:
+            with open(f"{path_to_draft}/config.json", "r") as f:
+                draft_config = json.load(f)
+            draft_tokenizer = Tokenizer.from_file(f"{path_to_draft}/tokenizer.json")
+            if draft_tokenizer.get_vocab() != self.tokenizer.get_vocab():
+                print(f"Draft model {draft_llm} has another tokenizer, speculative decoding is off")
+                return None
+            draft_session = SESSION_POOL.get(
+                f"{path_to_draft}/onnx/model_int8.onnx", providers, self.session_profile,
+                cache_dir=os.path.join(path_to_draft, "cache"),
+            )
+            draft_decoder = Decoder(
+                draft_session,
+                num_layers=draft_config["num_hidden_layers"],
+                num_kv_heads=draft_config["num_key_value_heads"],
+                head_dim=draft_config["head_dim"],
+                use_att_mask=self.llm_models.get(draft_llm, {}).get("att_mask", False),
+                capacity=128,
+                max_len=draft_config.get("max_position_embeddings"),
+            )
+            self.draft_tokens = int(spec.get("draft_tokens", 4))
+            print(f"Speculative decoding: {draft_llm} drafts {self.draft_tokens} tokens for {llm}")
+            return DraftModel(draft_decoder, self.seed)
+        except Exception as e:
+            print(f"Could not load the draft model: {e}")
+            return None
+
+    def prepare_kv_snapshots(self, decoder, path_to_model):
+        """ Prefills every system prompt once (or loads it from config_dir) so the chats start after it """
+        if not self.config_dir:
+            return
+        try:
+            snap_dir = os.path.join(self.config_dir, "kv_snapshots")
+            os.makedirs(snap_dir, exist_ok=True)
+            snap_path = os.path.join(snap_dir, f"{self.llm}.npz")
+            model_stat = os.stat(f"{path_to_model}/onnx/model_int8.onnx")
+            stamp = f"{model_stat.st_size}:{int(model_stat.st_mtime)}"
+            decoder.load_snapshots(snap_path, stamp)
+            changed = False
+            for name, content in SYSTEM_PROMPTS.items():
+                prefix = self.apply_chat_template([{"role": "system", "content": content}])["input_ids"][0]
+                if not decoder.has_snapshot(name, prefix):
+                    decoder.add_snapshot(name, prefix)
+                    changed = True
+            if changed:
+                decoder.save_snapshots(snap_path, stamp)
+            decoder.reset()
+        except Exception as e:
+            print(f"Could not prepare the kv snapshots: {e}")
+
+    # ================== CHAT TEMPLATE ==================
+    def format_message(self, msg):
+        start_prompt = self.llm_models[self.llm]['tokens'][1]
+        end_prompt = self.llm_models[self.llm]['tokens'][2]
+        role = msg["role"]
+        content = msg["content"].strip()  # Strip for cleanliness
+        if role == "system":
+            return f"{start_prompt}system\n{content}{end_prompt}\n"
+        elif role == "user":
+            return f"{start_prompt}user\n{content}{end_prompt}\n"
+        elif role == "assistant" or role == "model":
+            return f"{start_prompt}assistant\n{content}{end_prompt}\n"
+        return ""
+
+    def apply_chat_template(self, messages, add_generation_prompt=False, tokenize=True, return_tensors="np"):
+        init_prompt = self.llm_models[self.llm]['tokens'][0]
+        start_prompt = self.llm_models[self.llm]['tokens'][1]
+        prompt = init_prompt
+        for msg in messages:
+            prompt += self.format_message(msg)
+
+        if add_generation_prompt:
+            prompt += f"{start_prompt}assistant\n"
+
+        if not tokenize:
+            return prompt
+
+        # Tokenize (encode to IDs)
+        encoding = self.tokenizer.encode(prompt, add_special_tokens=False)  # False to avoid extra BOS if already added
+        token_ids = encoding.ids
+
+        if return_tensors == "np":
+            input_ids = np.array([token_ids], dtype=np.int64)  # Batch size 1
+        else:
+            input_ids = np.array(token_ids, dtype=np.int64)
+
+        # Return dict like HF (only input_ids)
+        return {"input_ids": input_ids}
+
+    # ================== GENERATION ==================
+    def stream(self, messages, max_new_tokens=256, sample_kw=None, greedy=False, doc_qa=False, cancel_token=None):
+        """
+        Generator of the answer text, in complete UTF-8 pieces. `messages` starts with the system prompt &
+        ends with the new message, the history in between is trimmed to the context. `doc_qa` drafts the
+        answer from the prompt (RAG), `cancel_token` (inferenceWorker.CancelToken) stops it early.
+        Token & speculative decoding counts of the last answer are kept in `last_stats`.
+        """
+        if not self.ready:
+            raise RuntimeError("No model is loaded")
+        sample_kw = dict(sample_kw or {"temperature": 0.15, "top_k": 20, "top_p": 0.85})
+        # system prompt + the newest history that fits next to the answer budget
+        messages, max_new_tokens = self.context_builder.build(messages, int(max_new_tokens))
+        input_ids = self.apply_chat_template(messages, add_generation_prompt=True)["input_ids"]
+        print(f"Input token count: {input_ids.shape[-1]}, answer budget: {max_new_tokens} tokens")
+        stats = {"prompt_tokens": int(input_ids.shape[-1]), "new_tokens": 0, "drafted": 0, "accepted": 0}
+        self.last_stats = stats
+        # document answers copy the context, so they are drafted by prompt lookup
+        if doc_qa and self.prompt_lookup:
+            proposer, draft_tokens = self.prompt_lookup, self.lookup_tokens
+        else:
+            proposer, draft_tokens = self.drafter, self.draft_tokens
+        # the decoder keeps the kv cache in preallocated buffers & only prefills the part of the
+        # prompt which differs from the previous turn, the proposer (if any) drafts tokens ahead
+        tokens = generate(
+            self.decoder, self.sampler, input_ids, max_new_tokens, sample_kw,
+            greedy=greedy, proposer=proposer, draft_tokens=draft_tokens, stats=stats,
+        )
+        detokenizer = StreamDetokenizer(self.tokenizer)
+        answer = ""
+        start = time.perf_counter()
+        try:
+            for next_token in tokens:
+                if next_token in self.eos_token_ids or (cancel_token is not None and cancel_token.cancelled):
+                    break
+                stats["new_tokens"] += 1
+                txt_update = detokenizer.add(next_token)
+                if txt_update:
+                    answer += txt_update
+                    yield txt_update
+                    if len(answer) > 20 and answer.endswith(".."):
+                        break
+            tail_txt = detokenizer.flush()
+            if tail_txt:
+                yield tail_txt
+        finally:
+            tokens.close()
+            stats["seconds"] = time.perf_counter() - start
+            if stats["drafted"]:
+                rate = 100 * stats["accepted"] / stats["drafted"]
+                print(f"Speculative decoding: accepted {stats['accepted']}/{stats['drafted']} draft tokens ({rate:.0f}%)")
+
+    def chat(self, messages, **kwargs):
+        """ The whole answer at once, see `stream` for the arguments """
+        return "".join(self.stream(messages, **kwargs))
+
+    def chat_batch(self, conversations, max_new_tokens=256, sample_kw=None, greedy=False):
+        """
+        Answers several conversations (message lists like for `stream`) in one batched decode loop, for
+        offline bulk jobs. The rows share the answer budget of the longest prompt. Returns the answers.
+        """
+        if not self.ready:
+            raise RuntimeError("No model is loaded")
+        sample_kw = dict(sample_kw or {"temperature": 0.15, "top_k": 20, "top_p": 0.85}, greedy=greedy)
+        built = [self.context_builder.build(messages, int(max_new_tokens)) for messages in conversations]
+        max_new_tokens = min(new_tokens for _, new_tokens in built)
+        prompts = [
+            self.apply_chat_template(messages, add_generation_prompt=True, return_tensors=None)["input_ids"].tolist()
+            for messages, _ in built
+        ]
+        print(f"Batch of {len(prompts)}: {sum(map(len, prompts))} input tokens, answer budget: {max_new_tokens} tokens")
+        # its own kv buffers (freed on return), the session is the one of the loaded model
+        decoder = Decoder(self.decoder_session, capacity=128, batch_size=len(prompts), **self.decoder_kw)
+        start = time.perf_counter()
+        outputs = generate_batch(decoder, prompts, max_new_tokens, sample_kw, eos_token_ids=self.eos_token_ids, seed=self.seed)
+        self.last_stats = {
+            "prompt_tokens": sum(map(len, prompts)),
+            "new_tokens": sum(map(len, outputs)),
+            "seconds": time.perf_counter() - start,
+        }
+        return [self.tokenizer.decode(ids, skip_special_tokens=True) for ids in outputs]
+
+# ================== COMMAND LINE ==================
+def main(argv=None):
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(prog="python -m chatEngine", description="OnLLM models without the UI")
+    parser.add_argument("--model-dir", required=True, help="folder holding the model folders (the app's model_files)")
+    parser.add_argument("--model", default="smollm2-135m")
+    parser.add_argument("--config-dir", default=None, help="kv snapshots & RAG library (default: config next to model-dir)")
+    parser.add_argument("--models-json", default=os.path.join(app_dir, "extra_models.json"))
+    parser.add_argument("--prompt", default=None, help="question (read from stdin if not given)")
+    parser.add_argument("--doc", default=None, help="pdf/docx to answer from (RAG)")
+    parser.add_argument("--batch", default=None, help="file with one question per line, answered in batches")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--max-tokens", type=int, default=256)
+    parser.add_argument("--temperature", type=float, default=0.15)
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument("--top-p", type=float, default=0.85)
+    parser.add_argument("--repetition-penalty", type=float, default=1.0)
+    parser.add_argument("--greedy", action="store_true")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    config_dir = args.config_dir or os.path.join(os.path.dirname(os.path.abspath(args.model_dir)), "config")
+    os.makedirs(config_dir, exist_ok=True)
+    llm_models = load_model_configs(args.models_json)
+    if args.model not in llm_models:
+        parser.error(f"unknown model {args.model}, known: {', '.join(llm_models)}")
+    if args.batch:
+        if args.doc:
+            parser.error("--batch does not work with --doc")
+        with open(args.batch, "r") as batch_file:
+            questions = [line.strip() for line in batch_file if line.strip()]
+        if not questions:
+            parser.error("empty batch file")
+    else:
+        question = args.prompt if args.prompt is not None else sys.stdin.read()
+        question = question.strip()
+        if not question:
+            parser.error("empty prompt")
+
+    # the answer goes to stdout, the engine logs to stderr (until main returns)
+    answer_out = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        engine = ChatEngine(args.model_dir, llm_models, config_dir, seed=args.seed)
+        engine.load(args.model)
+        sample_kw = {
+            "temperature": args.temperature,
+            "top_k": args.top_k,
+            "top_p": args.top_p,
+            "repetition_penalty": args.repetition_penalty,
+        }
+        if args.batch:
+            # one answer per question, separated by a blank line
+            batch_size = max(1, args.batch_size)
+            for first in range(0, len(questions), batch_size):
+                conversations = [
+                    [{"role": "system", "content": SYSTEM_PROMPTS["chat"]}, {"role": "user", "content": question}]
+                    for question in questions[first:first + batch_size]
+                ]
+                for answer in engine.chat_batch(conversations, args.max_tokens, sample_kw, greedy=args.greedy):
+                    answer_out.write(f"{answer.strip()}\n\n")
+                    answer_out.flush()
+            return 0
+        messages = [{"role": "system", "content": SYSTEM_PROMPTS["chat"]}, {"role": "user", "content": question}]
+        if args.doc:
+            from docRag import LocalRag
+            rag = LocalRag(model_dir=args.model_dir, config_dir=config_dir)
+            if not rag.start_rag_onnx_sess(args.doc):
+                print(f"Could not index {args.doc}")
+                return 1
+            messages = [
+                {"role": "system", "content": SYSTEM_PROMPTS["rag"]},
+                {"role": "user", "content": rag.get_rag_prompt(question)},
+            ]
+        for piece in engine.stream(messages, args.max_tokens, sample_kw, greedy=args.greedy, doc_qa=bool(args.doc)):
+            answer_out.write(piece)
+            answer_out.flush()
+        answer_out.write("\n")
+        stats = engine.last_stats
+        if stats.get("seconds"):
+            print(f"{stats['new_tokens']} tokens in {stats['seconds']:.2f}s ({stats['new_tokens'] / stats['seconds']:.1f} tokens/s)")
+        return 0
+    finally:
+        sys.stdout = answer_out
+
+if __name__ == "__main__":
+    sys.exit(main())
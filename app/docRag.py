@@ -1,11 +1,14 @@
-import sqlite3, json, re
+import sqlite3, json, re, hashlib
 import numpy as np
-from onnxruntime import InferenceSession
 import docx2txt
 from pypdf import PdfReader
 from tokenizers import Tokenizer
 import os
-from kivy.clock import Clock
+import time
+import threading
+
+from annIndex import IvfIndex
+from ortSession import SESSION_POOL, resolve_profile
 
 # ================== 1️⃣ TEXT EXTRACTION ==================
 def extract_docx_text(path):
@@ -16,15 +19,6 @@ def extract_docx_text(path):
         print(f"Error processing docx: {e}")
     return doc_txt
 
-def extract_pdf_text(path):
-    pdf_txt = ""
-    try:
-        reader = PdfReader(path)
-        pdf_txt = "\n".join(page.extract_text() or " " for page in reader.pages)
-    except Exception as e:
-        print(f"Error processing pdf: {e}")
-    return pdf_txt
-
 def clean_text(text):
     # Looks for a word ending in a hyphen, a newline, and another word.
     # Replaces "word-\nword" with "wordword"
@@ -34,15 +28,85 @@ def clean_text(text):
     text = text.replace('\n', " ")
     return text.strip()
 
+# ================== 2️⃣ STREAMING PIPELINE ==================
+def iter_pdf_pages(path):
+    """ Yields (page_no, total_pages, text) one page at a time """
+    try:
+        reader = PdfReader(path)
+        total = len(reader.pages)
+        for page_no, page in enumerate(reader.pages, start=1):
+            yield page_no, total, page.extract_text() or " "
+    except Exception as e:
+        print(f"Error processing pdf: {e}")
+        raise # a half read document must not be marked complete
+
+def iter_docx_pages(path, page_chars=3000):
+    """ docx has no pages, so the paragraphs are grouped into ~page_chars sized sections """
+    text = extract_docx_text(path)
+    sections = []
+    current = ""
+    for para in text.split("\n\n"):
+        current = f"{current}\n\n{para}" if current else para
+        if len(current) >= page_chars:
+            sections.append(current)
+            current = ""
+    if current:
+        sections.append(current)
+    for page_no, section in enumerate(sections, start=1):
+        yield page_no, len(sections), section
+
+def iter_doc_pages(path):
+    if path.endswith(".docx") or path.endswith(".docx.jpg"):
+        return iter_docx_pages(path)
+    elif path.endswith(".pdf") or path.endswith(".pdf.jpg"):
+        return iter_pdf_pages(path)
+    return None
+
+def iter_page_chunks(pages, chunk_size=500, overlap=50):
+    """
+    Cleans & chunks the pages as they arrive. Yields (page_no, total_pages, chunks) where chunks are the ones
+    completed by that page, the chunk boundaries are the same as chunking the whole text at once.
+    """
+    step = chunk_size - overlap
+    buf = ""
+    page_no = total = 0
+    for page_no, total, raw_text in pages:
+        page_text = clean_text(raw_text)
+        if page_text:
+            if re.search(r'\w-$', buf) and re.match(r'\w', page_text):
+                buf = buf[:-1] + page_text # "word-" at the end of the previous page
+            elif buf:
+                buf = f"{buf} {page_text}"
+            else:
+                buf = page_text
+        chunks = []
+        pos = 0
+        while len(buf) - pos >= chunk_size:
+            chunks.append(buf[pos:pos + chunk_size])
+            pos += step
+        buf = buf[pos:]
+        yield page_no, total, chunks
+    # whatever is left after the last page
+    tail = [buf[i:i + chunk_size] for i in range(0, len(buf), step)]
+    if tail:
+        yield page_no, total, tail
+
 # ================== 3️⃣ TOKENIZER & EMBEDDINGS ==================
 class HuggingFaceTokenizer:
-    def __init__(self, tokenizer_json, max_len=256):
+    def __init__(self, tokenizer_json, max_len=256, dynamic_padding=True, pad_multiple=8):
         # Load the tokenizer from the file
         self.tokenizer = Tokenizer.from_file(tokenizer_json)
-        
+        self.max_len = max_len
+        self.dynamic_padding = dynamic_padding
+        self.pad_multiple = pad_multiple if dynamic_padding else 1
+
         # Configure truncation and padding
         self.tokenizer.enable_truncation(max_length=max_len)
-        self.tokenizer.enable_padding(direction='right', length=max_len, pad_id=0, pad_token="[PAD]")
+        if dynamic_padding:
+            # pads only up to the longest item of a batch (rounded to pad_multiple)
+            self.tokenizer.enable_padding(direction='right', pad_id=0, pad_token="[PAD]", pad_to_multiple_of=pad_multiple)
+        else:
+            self.tokenizer.enable_padding(direction='right', length=max_len, pad_id=0, pad_token="[PAD]")
 
     def encode(self, text, max_len=None): # max_len is now handled by the instance
         # The library handles everything: CLS/SEP tokens, tokenization, padding
@@ -53,9 +117,18 @@ class HuggingFaceTokenizer:
         attn = np.array(encoded.attention_mask, dtype=np.int64)
         return ids, attn
 
+    def encode_batch(self, texts):
+        # Returns stacked (batch, seq) int64 arrays, tokenized in one call to the rust side
+        encodings = self.tokenizer.encode_batch(list(texts))
+        ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attn = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        return ids, attn
+
 class SentenceEmbedder:
     def __init__(self, model_path, tokenizer_json):
-        self.session = InferenceSession(model_path, providers=["CPUExecutionProvider"])
+        # shared through the session pool, so the embedder stays loaded across rag sessions within its budget
+        self.model_path = model_path
+        self.session = SESSION_POOL.get(model_path, ["CPUExecutionProvider"], resolve_profile())
 
         # --- Use the new tokenizer ---
         self.tokenizer = HuggingFaceTokenizer(tokenizer_json) 
@@ -63,21 +136,22 @@ class SentenceEmbedder:
         self.input_names = [i.name for i in self.session.get_inputs()]
         self.output_name = self.session.get_outputs()[0].name
 
-    def embed(self, sentences):
-        if isinstance(sentences, str):
-            sentences = [sentences]
+        # identity of the weights, used as part of the embedding cache keys
+        model_stat = os.stat(model_path)
+        model_name = os.path.basename(os.path.dirname(os.path.abspath(model_path)))
+        self.model_id = f"{model_name}:{model_stat.st_size}:{int(model_stat.st_mtime)}"
 
-        # The encode method now returns batched numpy arrays directly
-        # We can encode all sentences at once!
-        all_ids = []
-        all_masks = []
-        for s in sentences:
-            ids, mask = self.tokenizer.encode(s)
-            all_ids.append(ids)
-            all_masks.append(mask)
+    def encode(self, sentences):
+        # The tokenizer returns batched numpy arrays directly
+        return self.tokenizer.encode_batch(sentences)
 
-        input_ids = np.stack(all_ids)
-        attention_mask = np.stack(all_masks)
+    def run_model(self, input_ids, attention_mask):
+        # drop the padding columns which no row in this batch is using
+        seq_len = max(int(attention_mask.sum(axis=1).max()), 1)
+        multiple = self.tokenizer.pad_multiple
+        seq_len = min(-(-seq_len // multiple) * multiple, input_ids.shape[1])
+        input_ids = np.ascontiguousarray(input_ids[:, :seq_len])
+        attention_mask = np.ascontiguousarray(attention_mask[:, :seq_len])
 
         feed = {"input_ids": input_ids, "attention_mask": attention_mask}
 
@@ -91,6 +165,101 @@ class SentenceEmbedder:
         emb = sum_emb / np.clip(mask_exp.sum(axis=1), 1e-9, None)
         return emb.astype(np.float32)
 
+    def embed(self, sentences):
+        if isinstance(sentences, str):
+            sentences = [sentences]
+        input_ids, attention_mask = self.encode(sentences)
+        return self.run_model(input_ids, attention_mask)
+
+    def embed_batched(self, sentences, batch_size=16):
+        """
+        Embeds a big list in batches of `batch_size`. The sentences are bucketed by token length first,
+        so every batch is only padded to its own longest member. Output keeps the input order.
+        """
+        if isinstance(sentences, str):
+            sentences = [sentences]
+        if len(sentences) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        batch_size = max(int(batch_size), 1)
+        input_ids, attention_mask = self.encode(sentences)
+        order = np.argsort(attention_mask.sum(axis=1), kind="stable")
+        result = None
+        for start in range(0, len(order), batch_size):
+            idx = order[start:start + batch_size]
+            emb = self.run_model(input_ids[idx], attention_mask[idx])
+            if result is None:
+                result = np.empty((len(sentences), emb.shape[-1]), dtype=np.float32)
+            result[idx] = emb
+        return result
+
+# ================== EMBEDDING CACHE ==================
+class EmbeddingCache:
+    """
+    Content addressed cache of normalized chunk embeddings, keyed by sha1(model identity + chunk text).
+    It lives in its own sqlite file next to vector.db & keeps at most `max_entries` rows (LRU eviction).
+    """
+
+    def __init__(self, db_path, max_entries=50000) -> None:
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.conn = None
+
+    def open(self):
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache(
+                key TEXT PRIMARY KEY,
+                embedding BLOB,
+                last_used REAL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_last_used ON cache(last_used)")
+        self.conn.commit()
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    @staticmethod
+    def make_key(model_id, text):
+        return hashlib.sha1(f"{model_id}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        """ Returns {key: float32 vector} for the keys found in the cache & marks them as recently used """
+        found = {}
+        keys = list(keys)
+        for start in range(0, len(keys), 500): # stay below the sqlite variable limit
+            part = keys[start:start + 500]
+            placeholders = ",".join("?" * len(part))
+            rows = self.conn.execute(
+                f"SELECT key, embedding FROM cache WHERE key IN ({placeholders})", part
+            ).fetchall()
+            for key, blob in rows:
+                found[key] = np.frombuffer(blob, dtype=np.float32)
+        if found:
+            now = time.time()
+            with self.conn:
+                self.conn.executemany("UPDATE cache SET last_used = ? WHERE key = ?", ((now, k) for k in found))
+        return found
+
+    def put_many(self, items):
+        """ Stores (key, vector) pairs & evicts the least recently used rows above the size cap """
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, embedding, last_used) VALUES (?, ?, ?)",
+                ((k, np.ascontiguousarray(v, dtype=np.float32).tobytes(), now) for k, v in items)
+            )
+            total = self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            if total > self.max_entries:
+                self.conn.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_used LIMIT ?)",
+                    (total - self.max_entries,)
+                )
+
 def create_rag_prompt(question, context):
     prompt = f"""Based on the following context, please answer the question:
 
@@ -104,117 +273,489 @@ Question:
 """
     return prompt
 
+# supported on-disk formats for the embedding BLOBs
+EMB_DTYPES = {
+    "float32": np.float32,
+    "float16": np.float16,
+}
+
 # RAG prompt class
 class LocalRag:
     """
     The local RAG calls which will take a PDF or Word (doc/docx) & put it in on device embedding database.
+    Embeddings are stored as raw float32 (or float16) BLOBs & loaded back with np.frombuffer.
+    vector.db is a persistent library: every indexed file has a row in `documents` & its chunks are keyed by doc_id,
+    so selecting an already indexed file again does not re-embed it.
+    The embedder & the db connection are long lived (shared by all the docs & questions) & get released
+    after `idle_timeout` seconds without use to give the memory back on low RAM phones.
+    The callbacks are handed to `dispatch(fn)` (the app runs them on the UI thread), without it they
+    are called right away on the calling thread.
     """
 
-    def __init__(self, model_dir, config_dir) -> None:
+    def __init__(self, model_dir, config_dir, emb_dtype="float32", embed_batch_size=16, cache_max_entries=50000, idle_timeout=300,
+                 ann_min_rows=20000, ann_nprobe=8, dispatch=None) -> None:
         self.model_dir = model_dir
         self.config_dir = config_dir
+        self.dispatch = dispatch
         self.conn = None
         self.cursor = None
+        if emb_dtype not in EMB_DTYPES:
+            raise ValueError(f"Unsupported embedding dtype: {emb_dtype}")
+        self.emb_dtype = emb_dtype
+        self.embed_batch_size = embed_batch_size # 1 means one onnx run per chunk
+        self.embedder = None
+        # every db / onnx access goes through this lock (callers run on their own threads)
+        self.lock = threading.RLock()
+        self.idle_timeout = idle_timeout # seconds, None keeps everything loaded
+        self.idle_timer = None
+        self.last_used = time.time()
+        self.emb_cache = EmbeddingCache(os.path.join(config_dir, "embed_cache.db"), max_entries=cache_max_entries)
+        # documents used by the queries (None means the whole library)
+        self.active_doc_ids = None
+        # in-memory search matrix of the library (rows are unit vectors)
+        self.emb_matrix = None
+        self.row_ids = None
+        self.row_doc_ids = None
+        # approximate search for big libraries, ann_nprobe is the recall / latency knob
+        self.ann = IvfIndex(os.path.join(config_dir, "vector.ivf.npz"), nprobe=ann_nprobe)
+        self.ann_min_rows = ann_min_rows # None disables the ANN index
+        self.ann_ready = False
 
     # ================== SQLITE VECTOR STORE ==================
+    def open_db(self, db_path):
+        # shared by the worker threads, access is serialized with self.lock
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        # WAL + NORMAL sync: one fsync per checkpoint instead of one per commit
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA cache_size=-8000") # ~8MB page cache
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.cursor = self.conn.cursor()
+
     def init_db(self):
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS meta(
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        """)
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS documents(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                path TEXT UNIQUE,
+                size INTEGER,
+                mtime REAL,
+                content_hash TEXT,
+                num_chunks INTEGER DEFAULT 0,
+                indexed_at REAL,
+                complete INTEGER DEFAULT 0
+            )
+        """)
         self.cursor.execute("""
             CREATE TABLE IF NOT EXISTS docs(
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                doc_id INTEGER,
                 chunk TEXT,
-                embedding TEXT
+                embedding BLOB
             )
         """)
+        self.migrate_db()
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_docs_doc_id ON docs(doc_id)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_hash ON documents(content_hash)")
         self.conn.commit()
 
-    def insert_chunk(self, chunk, embedding):
-        self.cursor.execute("INSERT INTO docs (chunk, embedding) VALUES (?, ?)",
-                     (chunk, json.dumps(embedding.tolist())))
+    def get_meta(self, key, default=None):
+        row = self.cursor.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def migrate_db(self):
+        """ Converts an older vector.db (JSON text embeddings) or a db in another dtype to the current BLOB format """
+        doc_cols = [r[1] for r in self.cursor.execute("PRAGMA table_info(docs)").fetchall()]
+        if "doc_id" not in doc_cols:
+            # single document db from the older versions, we do not know which file it belongs to
+            print("Migrating vector.db to the document library, dropping the unowned chunks")
+            self.cursor.execute("DELETE FROM docs")
+            self.cursor.execute("ALTER TABLE docs ADD COLUMN doc_id INTEGER")
+            self.invalidate_matrix()
+        lib_cols = [r[1] for r in self.cursor.execute("PRAGMA table_info(documents)").fetchall()]
+        if "complete" not in lib_cols:
+            self.cursor.execute("ALTER TABLE documents ADD COLUMN complete INTEGER DEFAULT 0")
+            self.cursor.execute("UPDATE documents SET complete = 1 WHERE num_chunks > 0")
+        stored_dtype = self.get_meta("emb_dtype")
+        has_text = self.cursor.execute(
+            "SELECT 1 FROM docs WHERE typeof(embedding) = 'text' LIMIT 1"
+        ).fetchone()
+        if stored_dtype == self.emb_dtype and not has_text:
+            return
+        rows = self.cursor.execute("SELECT id, embedding FROM docs").fetchall()
+        if rows:
+            print(f"Migrating {len(rows)} embeddings to {self.emb_dtype} BLOBs")
+        new_rows = []
+        for row_id, emb in rows:
+            if isinstance(emb, str):
+                vec = np.array(json.loads(emb), dtype=np.float32)
+            else:
+                vec = np.frombuffer(emb, dtype=EMB_DTYPES[stored_dtype or "float32"])
+            new_rows.append((self.to_blob(vec), row_id))
+        self.cursor.executemany("UPDATE docs SET embedding = ? WHERE id = ?", new_rows)
+        self.set_meta("emb_dtype", self.emb_dtype)
+        if rows:
+            self.invalidate_matrix()
+            self.conn.commit()
+            self.cursor.execute("VACUUM") # give back the space used by the json text
+
+    def to_blob(self, embedding):
+        return np.ascontiguousarray(embedding, dtype=EMB_DTYPES[self.emb_dtype]).tobytes()
+
+    def insert_chunk(self, chunk, embedding, doc_id=None):
+        self.cursor.execute("INSERT INTO docs (doc_id, chunk, embedding) VALUES (?, ?, ?)",
+                     (doc_id, chunk, self.to_blob(embedding)))
         self.conn.commit()
+        self.invalidate_matrix()
 
-    def start_rag_onnx_sess(self, doc_path, callback=None):
-        print(f"***Doc path in RAG: {doc_path}")
-        onnx_path = os.path.join(self.model_dir, "all-MiniLM-L6-V2", "model.onnx")
-        tokenizer_path = os.path.join(self.model_dir, "all-MiniLM-L6-V2", "tokenizer.json")
-        db_path = os.path.join(self.config_dir, "vector.db")
-        if self.conn:
-            self.conn.close() # close previous db connection
-        if os.path.exists(db_path):
-            os.remove(db_path) # remove older rag db
-        self.conn = sqlite3.connect(db_path)
-        self.cursor = self.conn.cursor()
-        self.init_db()
-        self.embedder = SentenceEmbedder(onnx_path, tokenizer_path)
-        indx_stat = self.build_index(doc_path)
-        self.conn_closer()
-        if indx_stat:
-            final_stat = True
+    def insert_chunks(self, pairs, doc_id=None):
+        """
+        Bulk ingestion of (chunk, embedding) pairs with a single executemany in one transaction.
+        Returns the number of rows written.
+        """
+        count = 0
+        def rows():
+            nonlocal count
+            for chunk, embedding in pairs:
+                count += 1
+                yield (doc_id, chunk, self.to_blob(embedding))
+        with self.conn: # commits once at the end (or rolls back on error)
+            self.conn.executemany("INSERT INTO docs (doc_id, chunk, embedding) VALUES (?, ?, ?)", rows())
+        self.invalidate_matrix()
+        return count
+
+    def invalidate_matrix(self):
+        self.emb_matrix = None
+        self.row_ids = None
+        self.row_doc_ids = None
+        self.ann_ready = False
+
+    def load_matrix(self):
+        """ Loads all the embeddings of the library into one contiguous float32 matrix """
+        rows = self.cursor.execute("SELECT id, doc_id, embedding FROM docs ORDER BY id").fetchall()
+        self.row_ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+        self.row_doc_ids = np.fromiter((r[1] or 0 for r in rows), dtype=np.int64, count=len(rows))
+        if rows:
+            flat = np.frombuffer(b"".join(r[2] for r in rows), dtype=EMB_DTYPES[self.emb_dtype])
+            self.emb_matrix = np.ascontiguousarray(flat.reshape(len(rows), -1), dtype=np.float32)
         else:
-            final_stat = False
+            self.emb_matrix = np.zeros((0, 0), dtype=np.float32)
+        print(f"Loaded search matrix: {self.emb_matrix.shape}")
+        if self.ann_min_rows is not None:
+            try:
+                # only the rows added / removed since the last time are (re)assigned
+                self.ann.sync(self.row_ids, self.emb_matrix, min_rows=self.ann_min_rows)
+            except Exception as e:
+                print(f"IVF index error: {e}")
+                self.ann.reset()
+            self.ann_ready = (
+                self.ann.is_trained and len(self.row_ids) >= self.ann_min_rows
+                and np.array_equal(self.ann.row_ids, self.row_ids)
+            )
+
+    # ================== DOCUMENT LIBRARY ==================
+    def file_hash(self, path, block_size=1 << 20):
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def find_document(self, doc_path):
+        """ Returns the doc_id if the file (or the same content at another path) is already indexed """
+        stat = os.stat(doc_path)
+        row = self.cursor.execute(
+            "SELECT id, size, mtime FROM documents WHERE path = ? AND complete = 1", (doc_path,)
+        ).fetchone()
+        if row and row[1] == stat.st_size and row[2] == stat.st_mtime:
+            return row[0] # unchanged file, no need to even hash it
+        content_hash = self.file_hash(doc_path)
+        row = self.cursor.execute(
+            "SELECT id FROM documents WHERE content_hash = ? AND complete = 1", (content_hash,)
+        ).fetchone()
+        if row:
+            # same content (touched, copied or renamed file), refresh the stats of the path we know
+            self.cursor.execute(
+                "UPDATE documents SET size = ?, mtime = ? WHERE id = ? AND path = ?",
+                (stat.st_size, stat.st_mtime, row[0], doc_path)
+            )
+            self.conn.commit()
+            return row[0]
+        return None
+
+    def add_document(self, doc_path):
+        """ Creates (or resets) the library row of a file & returns its doc_id """
+        stat = os.stat(doc_path)
+        old = self.cursor.execute("SELECT id FROM documents WHERE path = ?", (doc_path,)).fetchone()
+        if old:
+            self.remove_document(old[0])
+        self.cursor.execute(
+            "INSERT INTO documents (path, size, mtime, content_hash, indexed_at) VALUES (?, ?, ?, ?, ?)",
+            (doc_path, stat.st_size, stat.st_mtime, self.file_hash(doc_path), time.time())
+        )
+        self.conn.commit()
+        return self.cursor.lastrowid
+
+    def remove_document(self, doc_id):
+        with self.lock:
+            conn = self.get_conn()
+            with conn:
+                conn.execute("DELETE FROM docs WHERE doc_id = ?", (doc_id,))
+                conn.execute("DELETE FROM documents WHERE id = ?", (doc_id,))
+            self.invalidate_matrix()
+
+    def list_documents(self):
+        with self.lock:
+            self.get_conn()
+            rows = self.cursor.execute(
+                "SELECT id, path, size, num_chunks, indexed_at, complete FROM documents WHERE complete = 1 ORDER BY indexed_at DESC"
+            ).fetchall()
+        return [
+            {"id": r[0], "path": r[1], "size": r[2], "num_chunks": r[3], "indexed_at": r[4], "complete": bool(r[5])}
+            for r in rows
+        ]
+
+    def select_documents(self, doc_ids=None):
+        """ Sets the documents used by the queries, None means the whole library """
+        self.active_doc_ids = list(doc_ids) if doc_ids is not None else None
+
+    def load_embedder(self):
+        if self.embedder is None:
+            onnx_path = os.path.join(self.model_dir, "all-MiniLM-L6-V2", "model.onnx")
+            tokenizer_path = os.path.join(self.model_dir, "all-MiniLM-L6-V2", "tokenizer.json")
+            self.embedder = SentenceEmbedder(onnx_path, tokenizer_path)
+        return self.embedder
+
+    # ================== SESSION MANAGER ==================
+    def get_conn(self):
+        if self.conn is None:
+            self.open_db(os.path.join(self.config_dir, "vector.db"))
+            self.init_db() # migrates an older db if needed
+        return self.conn
+
+    def touch(self):
+        """ Marks the session as used & arms the idle timer """
+        self.last_used = time.time()
+        if self.idle_timeout and self.idle_timer is None:
+            self.schedule_idle_check(self.idle_timeout)
+
+    def schedule_idle_check(self, delay):
+        self.idle_timer = threading.Timer(delay, self.idle_check)
+        self.idle_timer.daemon = True
+        self.idle_timer.start()
+
+    def idle_check(self):
+        with self.lock:
+            self.idle_timer = None
+            idle_for = time.time() - self.last_used
+            if idle_for >= self.idle_timeout:
+                self.release()
+            else:
+                self.schedule_idle_check(self.idle_timeout - idle_for)
+
+    def release(self):
+        """ Frees the onnx session, the db connection & the search matrix, they are reloaded on the next use """
+        with self.lock:
+            if self.embedder is not None or self.conn is not None:
+                print("Releasing the idle RAG session")
+            if self.embedder is not None:
+                SESSION_POOL.release(self.embedder.model_path)
+            self.embedder = None
+            self.conn_closer()
+            self.invalidate_matrix()
+
+    def warmup(self):
+        """ Loads the embedder, the db & the search matrix upfront so the first question is fast """
+        with self.lock:
+            self.get_conn()
+            # the first run allocates the onnx buffers
+            self.load_embedder().embed("warmup")
+            if self.emb_matrix is None:
+                self.load_matrix()
+            self.touch()
+
+    def call_back(self, callback, *args):
+        if self.dispatch is not None:
+            self.dispatch(lambda: callback(*args))
+        else:
+            callback(*args)
+
+    def start_rag_onnx_sess(self, doc_path, callback=None, progress_callback=None):
+        """
+        Adds the doc to the library (if needed) & makes it the active one. Indexing goes page by page,
+        `progress_callback(page_no, total_pages, num_chunks)` is called after every page & the pages
+        indexed so far can already be queried.
+        """
+        print(f"***Doc path in RAG: {doc_path}")
+        final_stat = False
+        try:
+            with self.lock:
+                self.get_conn()
+                doc_id = self.find_document(doc_path)
+                is_new = not doc_id
+                if is_new:
+                    self.load_embedder()
+                    doc_id = self.add_document(doc_path)
+                else:
+                    print(f"Document is already in the library (doc_id: {doc_id})")
+                self.select_documents([doc_id])
+                self.touch()
+            if is_new:
+                on_page = None
+                if progress_callback:
+                    on_page = lambda *args: self.call_back(progress_callback, *args)
+                if not self.build_index(doc_path, doc_id, progress_callback=on_page):
+                    self.remove_document(doc_id)
+                    self.select_documents([])
+                    doc_id = None
+            final_stat = bool(doc_id)
+        except Exception as e:
+            print(f"Error while indexing the doc: {e}")
         if callback:
-            Clock.schedule_once(lambda dt: callback(final_stat))
+            self.call_back(callback, final_stat)
         else:
             return final_stat
 
     # ================== PIPELINE FUNCTIONS ==================
-    def build_index(self, file_path):
-        if file_path.endswith(".docx"):
-            text = extract_docx_text(file_path)
-        elif file_path.endswith(".pdf"):
-            text = extract_pdf_text(file_path)
-        elif file_path.endswith(".pdf.jpg"):
-            text = extract_pdf_text(file_path)
-        elif file_path.endswith(".docx.jpg"):
-            text = extract_docx_text(file_path)
-        else:
+    def build_index(self, file_path, doc_id=None, progress_callback=None):
+        """
+        extraction -> cleaning -> chunking -> embedding -> insert as a page by page generator pipeline.
+        The lock is only held while a page is embedded & written, so queries can run in between.
+        """
+        pages = iter_doc_pages(file_path)
+        if pages is None:
             return False
-        if len(text) <= 0:
+        written = 0
+        try:
+            for page_no, total_pages, chunks in iter_page_chunks(pages):
+                if chunks:
+                    with self.lock:
+                        self.get_conn()
+                        norm_embs = self.embed_chunks(chunks)
+                        # Save the normalized embeddings of this page in one transaction
+                        written += self.insert_chunks(zip(chunks, norm_embs), doc_id=doc_id)
+                        if doc_id is not None:
+                            self.cursor.execute("UPDATE documents SET num_chunks = ? WHERE id = ?", (written, doc_id))
+                            self.conn.commit()
+                        self.touch()
+                if progress_callback:
+                    progress_callback(page_no, total_pages, written)
+        except Exception as e:
+            # not complete, so the caller drops it & the next pick indexes the file again
+            print(f"Indexing stopped after {written} chunks: {e}")
             return False
-        text = clean_text(text)
-        # chunk properties
-        chunk_size = 500
-        overlap = 50 # 10%
-        step = chunk_size - overlap
-        chunks = [text[i:i + chunk_size] for i in range(0, len(text), step)]
-        for ch in chunks:
-            emb = self.embedder.embed(ch)[0]
-            # Normalize the vector to unit length
-            norm_emb = emb / np.linalg.norm(emb)
-            self.insert_chunk(ch, norm_emb) # Save the normalized embedding
-        print(f"Indexed {len(chunks)} chunks from {file_path}")
-        if len(chunks) >= 1:
+        if doc_id is not None and written >= 1:
+            with self.lock:
+                self.get_conn()
+                self.cursor.execute("UPDATE documents SET complete = 1 WHERE id = ?", (doc_id,))
+                self.conn.commit()
+        print(f"Indexed {written} chunks from {file_path}")
+        if written >= 1:
             return True
         else:
             return False
 
-    def search_similar(self, query_emb, top_k=3): # query_emb is now normalized
-        rows = self.cursor.execute("SELECT chunk, embedding FROM docs").fetchall()
-        results = []
-        for chunk, emb_json in rows:
-            emb = np.array(json.loads(emb_json)) # This is already normalized
-            # --- SIMPLIFIED FORMULA ---
-            sim = np.dot(query_emb, emb) 
-            results.append((chunk, float(sim)))
-        results.sort(key=lambda x: x[1], reverse=True)
-        return results[:top_k]
-
-    def query_pipeline(self, question, top_k=3):
-        q_emb = self.embedder.embed(question)[0]
+    def embed_chunks(self, chunks):
+        """
+        Returns the normalized embeddings of the chunks. Duplicate chunks (within the doc or already
+        seen in another doc) come from the embedding cache, only the new texts go through onnx.
+        """
+        model_id = self.embedder.model_id
+        keys = [EmbeddingCache.make_key(model_id, ch) for ch in chunks]
+        try:
+            self.emb_cache.open()
+            cached = self.emb_cache.get_many(set(keys))
+        except Exception as e:
+            print(f"Embedding cache error: {e}")
+            self.emb_cache.close()
+            cached = {}
+        # unique chunks which are not in the cache yet
+        to_embed = {}
+        for key, ch in zip(keys, chunks):
+            if key not in cached and key not in to_embed:
+                to_embed[key] = ch
+        if to_embed:
+            embs = self.embedder.embed_batched(list(to_embed.values()), batch_size=self.embed_batch_size)
+            # Normalize the vectors to unit length
+            norm_embs = embs / np.clip(np.linalg.norm(embs, axis=1, keepdims=True), 1e-12, None)
+            new_items = list(zip(to_embed.keys(), norm_embs))
+            cached.update(new_items)
+            if self.emb_cache.conn:
+                try:
+                    self.emb_cache.put_many(new_items)
+                except Exception as e:
+                    print(f"Embedding cache error: {e}")
+        self.emb_cache.close()
+        print(f"Embedded {len(to_embed)} of {len(chunks)} chunks, rest from the cache")
+        if not chunks:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack([cached[k] for k in keys])
+
+    def search_similar(self, query_emb, top_k=3, doc_ids=None): # query_emb is now normalized
+        if self.emb_matrix is None:
+            self.load_matrix()
+        if len(self.row_ids) == 0 or top_k <= 0:
+            return []
+        query_emb = np.asarray(query_emb, dtype=np.float32)
+        positions = None
+        if self.ann_ready:
+            # only the rows in the closest IVF clusters are scored
+            positions = self.ann.candidates(query_emb)
+            if doc_ids is not None:
+                positions = positions[np.isin(self.row_doc_ids[positions], np.asarray(doc_ids, dtype=np.int64))]
+            if len(positions) < top_k:
+                positions = None # too few candidates, use the exact search
+        if positions is not None:
+            sims = self.emb_matrix[positions] @ query_emb
+            num_rows = len(positions)
+        else:
+            # cosine similarity of all the chunks in one matrix-vector product
+            sims = self.emb_matrix @ query_emb
+            num_rows = len(self.row_ids)
+            if doc_ids is not None:
+                in_docs = np.isin(self.row_doc_ids, np.asarray(doc_ids, dtype=np.int64))
+                num_rows = int(in_docs.sum())
+                if num_rows == 0:
+                    return []
+                sims[~in_docs] = -np.inf
+        k = min(top_k, num_rows)
+        top_idx = np.argpartition(-sims, k - 1)[:k]
+        top_idx = top_idx[np.argsort(-sims[top_idx])]
+        top_rows = positions[top_idx] if positions is not None else top_idx
+        # only the winning chunks are read back from sqlite
+        top_ids = [int(i) for i in self.row_ids[top_rows]]
+        placeholders = ",".join("?" * len(top_ids))
+        chunk_map = dict(self.cursor.execute(
+            f"SELECT id, chunk FROM docs WHERE id IN ({placeholders})", top_ids
+        ).fetchall())
+        return [(chunk_map[row_id], float(sims[i])) for row_id, i in zip(top_ids, top_idx)]
+
+    def query_pipeline(self, question, top_k=3, doc_ids=None):
+        if doc_ids is None:
+            doc_ids = self.active_doc_ids
+        q_emb = self.load_embedder().embed(question)[0]
         norm_q_emb = q_emb / np.linalg.norm(q_emb)
-        top_chunks = self.search_similar(norm_q_emb, top_k)
+        top_chunks = self.search_similar(norm_q_emb, top_k, doc_ids=doc_ids)
         context = " ".join(ch for ch, _ in top_chunks)
         context = context.replace("\n", " ")
         return context
 
-    def get_rag_prompt(self, question, callback=None):
-        db_path = os.path.join(self.config_dir, "vector.db")
-        self.conn = sqlite3.connect(db_path)
-        self.cursor = self.conn.cursor()
-        context = self.query_pipeline(question)
+    def get_rag_prompt(self, question, callback=None, doc_ids=None):
+        with self.lock:
+            self.get_conn()
+            context = self.query_pipeline(question, doc_ids=doc_ids)
+            self.touch()
         final_prompt = create_rag_prompt(question, context)
-        self.conn_closer()
         if callback:
-            Clock.schedule_once(lambda dt: callback(final_prompt))
+            self.call_back(callback, final_prompt)
         else:
             return final_prompt
 
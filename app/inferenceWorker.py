@@ -0,0 +1,77 @@
+import itertools
+import threading
+import queue
+from concurrent.futures import Future
+
+# job priorities, a lower number runs first
+PRIORITY_RETRIEVAL = 0 # model loading & RAG retrieval, short & needed before the answer
+PRIORITY_GENERATION = 1
+PRIORITY_BACKGROUND = 2 # warmups
+
+# ================== CANCELLATION ==================
+class CancelToken:
+    """ Cancellation flag shared by a job & whoever may cancel it (checked by the job between steps) """
+
+    def __init__(self) -> None:
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+# ================== WORKER ==================
+class InferenceWorker:
+    """
+    One background thread running the inference jobs one after the other, so the onnx sessions are never
+    used from two threads at once. Jobs are ordered by priority, then by submit order. A job whose token
+    is cancelled before it starts is skipped (its future is cancelled).
+    `submit` returns a concurrent.futures.Future, the `callback(future)` is handed to `dispatch`, which
+    runs it on the UI thread (for kivy: Clock.schedule_once).
+    """
+
+    def __init__(self, dispatch=None, name="inference-worker") -> None:
+        self.dispatch = dispatch
+        self.jobs = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, fn, *args, priority=PRIORITY_GENERATION, token=None, callback=None, **kwargs):
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(lambda done: self.call_back(callback, done))
+        self.jobs.put((priority, next(self.counter), (future, token, fn, args, kwargs)))
+        return future
+
+    def call_back(self, callback, future):
+        if self.dispatch is not None:
+            self.dispatch(lambda: callback(future))
+        else:
+            callback(future)
+
+    def run(self):
+        while True:
+            _, _, job = self.jobs.get()
+            if job is None:
+                break
+            future, token, fn, args, kwargs = job
+            if token is not None and token.cancelled:
+                future.cancel()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                print(f"Inference job error: {e}")
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def shutdown(self, wait=False):
+        """ Stops the thread after the jobs already queued """
+        self.jobs.put((float("inf"), next(self.counter), None))
+        if wait:
+            self.thread.join()
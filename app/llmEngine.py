@@ -0,0 +1,691 @@
+import os
+import numpy as np
+
+# onnx tensor types of the kv cache inputs
+ORT_NP_TYPES = {
+    "tensor(float)": np.float32,
+    "tensor(float16)": np.float16,
+}
+
+# ================== KV CACHE ==================
+class KVCache:
+    """
+    Preallocated key/value cache of the decoder. Every layer has two flat buffers sized for `capacity` tokens:
+    the past is read from one while onnxruntime writes the present into the other (ping-pong), so no
+    new K/V tensors are allocated per generated token.
+    """
+
+    def __init__(self, session, num_layers, num_kv_heads, head_dim, capacity, batch_size=1) -> None:
+        input_types = {i.name: i.type for i in session.get_inputs()}
+        self.past_names = [
+            f"past_key_values.{layer}.{kv}"
+            for layer in range(num_layers)
+            for kv in ("key", "value")
+        ]
+        # the present outputs come after the logits, in the same order as the past inputs
+        self.present_names = [o.name for o in session.get_outputs()[1:]]
+        self.dtype = ORT_NP_TYPES.get(input_types.get(self.past_names[0]), np.float32)
+        self.batch_size = batch_size
+        self.num_kv_heads = num_kv_heads
+        self.head_dim = head_dim
+        self.capacity = 0
+        self.buffers = []
+        self.current = 0 # which buffer of the pair holds the past
+        self.length = 0 # number of cached tokens
+        self.ensure_capacity(capacity)
+
+    def slot_size(self, length):
+        return self.batch_size * self.num_kv_heads * length * self.head_dim
+
+    def view(self, buf, length):
+        # contiguous (batch, heads, length, head_dim) view over the start of a flat buffer
+        return buf[:self.slot_size(length)].reshape(self.batch_size, self.num_kv_heads, length, self.head_dim)
+
+    def ensure_capacity(self, capacity):
+        if capacity <= self.capacity:
+            return
+        new_buffers = []
+        for j in range(len(self.past_names)):
+            pair = [np.zeros(self.slot_size(capacity), dtype=self.dtype) for _ in range(2)]
+            if self.length:
+                self.view(pair[0], self.length)[...] = self.past(j)
+            new_buffers.append(pair)
+        self.buffers = new_buffers
+        self.current = 0
+        self.capacity = capacity
+
+    def reset(self):
+        self.length = 0
+
+    def truncate(self, length):
+        """ Keeps only the first `length` tokens (the layout changes, so the kept part is copied once) """
+        if length >= self.length:
+            return
+        for j in range(len(self.past_names)):
+            self.view(self.buffers[j][1 - self.current], length)[...] = self.past(j)[:, :, :length, :]
+        self.current = 1 - self.current
+        self.length = length
+
+    def past(self, j):
+        return self.view(self.buffers[j][self.current], self.length)
+
+    def snapshot(self):
+        """ Copies of the cached (batch, heads, length, head_dim) tensors of every layer """
+        return [self.past(j).copy() for j in range(len(self.past_names))]
+
+    def load(self, arrays):
+        length = arrays[0].shape[2]
+        self.ensure_capacity(length)
+        self.length = length
+        for j, arr in enumerate(arrays):
+            self.past(j)[...] = arr
+
+    def present(self, j, new_tokens):
+        return self.view(self.buffers[j][1 - self.current], self.length + new_tokens)
+
+    def feeds(self):
+        return {name: self.past(j) for j, name in enumerate(self.past_names)}
+
+    def bind(self, binding, new_tokens):
+        """ Binds the past views as inputs & the next buffers as the present outputs """
+        for j, (past_name, present_name) in enumerate(zip(self.past_names, self.present_names)):
+            past = self.past(j)
+            present = self.present(j, new_tokens)
+            binding.bind_input(past_name, "cpu", 0, self.dtype, past.shape, past.ctypes.data)
+            binding.bind_output(present_name, "cpu", 0, self.dtype, present.shape, present.ctypes.data)
+
+    def advance(self, new_tokens):
+        """ The presents written by the last run become the past """
+        self.current = 1 - self.current
+        self.length += new_tokens
+
+    def store(self, presents, new_tokens):
+        """ Copies the presents returned by a plain session.run (no IOBinding) """
+        for j, present in enumerate(presents):
+            self.present(j, new_tokens)[...] = present
+        self.advance(new_tokens)
+
+def common_prefix_len(a, b):
+    n = min(len(a), len(b))
+    if n == 0:
+        return 0
+    diff = np.flatnonzero(np.asarray(a[:n]) != np.asarray(b[:n]))
+    return int(diff[0]) if len(diff) else n
+
+# ================== DECODER ==================
+class Decoder:
+    """
+    Runs the onnx decoder on top of a KVCache. With IOBinding the presents are written straight into
+    the cache buffers & the decode logits into a reused buffer, otherwise it falls back to session.run.
+    The returned logits are only valid until the next step.
+    It remembers the tokens in the cache, so `prefill` only runs the part of a new prompt which differs
+    from the previous conversation (prefix cache). Snapshots of fixed prefixes (like the system prompts)
+    can be kept as well, a prompt starting with one of them begins decoding from its snapshot.
+    """
+
+    def __init__(self, session, num_layers, num_kv_heads, head_dim, use_att_mask=True, capacity=512, batch_size=1, prefix_cache=True, max_len=None) -> None:
+        self.session = session
+        self.max_len = max_len # model context, the buffers never grow past it
+        if max_len:
+            capacity = min(capacity, max_len)
+        self.prefix_cache = prefix_cache and batch_size == 1
+        self.tokens = [] # token ids held by the cache (batch size 1 only)
+        self.snapshots = {} # name: (prefix token ids, kv arrays)
+        self.use_att_mask = use_att_mask
+        self.batch_size = batch_size
+        self.cache = KVCache(session, num_layers, num_kv_heads, head_dim, capacity, batch_size)
+        self.logits_name = session.get_outputs()[0].name
+        self.binding = None
+        try:
+            self.binding = session.io_binding()
+        except Exception as e:
+            print(f"IOBinding is not available: {e}")
+        self.logits_buf = None
+        self.mask_buf = None
+        self.pos_buf = None
+        self.pad_lengths = np.zeros(batch_size, dtype=np.int64) # left padding of every row
+        self.reserve(capacity)
+
+    def reserve(self, total_len):
+        """ Makes sure the cache, mask & position buffers can hold `total_len` tokens """
+        if self.pos_buf is None:
+            capacity = total_len # first allocation: exactly the requested size
+        elif total_len <= self.pos_buf.shape[1]:
+            return
+        else:
+            # grow in steps so a long chat does not reallocate on every turn (up to the model context)
+            capacity = 2 * self.cache.capacity
+            if self.max_len:
+                capacity = min(capacity, self.max_len)
+            capacity = max(total_len, capacity)
+        self.cache.ensure_capacity(capacity)
+        self.mask_buf = np.ones((self.batch_size, capacity), dtype=np.int64)
+        self.pos_buf = np.tile(np.arange(capacity, dtype=np.int64), (self.batch_size, 1))
+        self.apply_padding()
+
+    def set_padding(self, pad_lengths):
+        """ Left padding of every row of the next batch: masked out & the positions start after it """
+        pad_lengths = np.asarray(pad_lengths, dtype=np.int64)
+        if pad_lengths.any() and not self.use_att_mask:
+            raise ValueError("Left padding needs a model with an attention mask input")
+        self.pad_lengths = pad_lengths
+        self.apply_padding()
+
+    def apply_padding(self):
+        positions = np.arange(self.mask_buf.shape[1], dtype=np.int64)
+        self.mask_buf[...] = positions[None, :] >= self.pad_lengths[:, None]
+        np.maximum(positions[None, :] - self.pad_lengths[:, None], 0, out=self.pos_buf)
+
+    def reset(self):
+        self.cache.reset()
+        self.tokens = []
+        if self.pad_lengths.any():
+            self.set_padding(np.zeros(self.batch_size, dtype=np.int64))
+
+    def truncate(self, length):
+        self.cache.truncate(length)
+        del self.tokens[length:]
+
+    def prefill(self, input_ids, quiet=False):
+        """ Runs a full prompt, reusing the cached kv of its longest common prefix with the cache """
+        reuse = 0
+        if self.prefix_cache:
+            prompt = input_ids[0]
+            reuse = common_prefix_len(self.tokens, prompt)
+            snap_name = self.best_snapshot(prompt)
+            if snap_name and len(self.snapshots[snap_name][0]) > reuse:
+                self.load_snapshot(snap_name)
+                reuse = len(self.tokens)
+            # at least one token has to run to get the next token logits
+            reuse = min(reuse, len(prompt) - 1)
+            if reuse > 0 and not quiet:
+                print(f"Prefix cache: reusing {reuse} of {len(prompt)} prompt tokens")
+        self.truncate(reuse)
+        return self.step(input_ids[:, reuse:])
+
+    # ================== KV SNAPSHOTS ==================
+    def add_snapshot(self, name, prefix_ids):
+        """ Prefills `prefix_ids` once & keeps a copy of its kv """
+        prefix_ids = np.asarray(prefix_ids, dtype=np.int64)
+        self.reset()
+        self.step(prefix_ids[None, :])
+        self.snapshots[name] = (prefix_ids, self.cache.snapshot())
+
+    def has_snapshot(self, name, prefix_ids):
+        snap = self.snapshots.get(name)
+        return snap is not None and np.array_equal(snap[0], prefix_ids)
+
+    def best_snapshot(self, prompt):
+        """ Name of the longest snapshot which is a strict prefix of the prompt """
+        best = None
+        for name, (prefix_ids, _) in self.snapshots.items():
+            size = len(prefix_ids)
+            if size < len(prompt) and np.array_equal(prompt[:size], prefix_ids):
+                if best is None or size > len(self.snapshots[best][0]):
+                    best = name
+        return best
+
+    def load_snapshot(self, name):
+        prefix_ids, arrays = self.snapshots[name]
+        self.reserve(len(prefix_ids))
+        self.cache.load(arrays)
+        self.tokens = prefix_ids.tolist()
+
+    def save_snapshots(self, path, stamp):
+        """ Persists the snapshots, `stamp` identifies the model files they were made with """
+        data = {"stamp": np.array(stamp)}
+        for name, (prefix_ids, arrays) in self.snapshots.items():
+            data[f"{name}/tokens"] = prefix_ids
+            for j, arr in enumerate(arrays):
+                data[f"{name}/{j}"] = arr
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, **data)
+        os.replace(tmp_path, path)
+
+    def load_snapshots(self, path, stamp):
+        """ Loads the persisted snapshots if they were made with the same model files """
+        if not os.path.exists(path):
+            return False
+        try:
+            with np.load(path) as data:
+                if str(data["stamp"]) != stamp:
+                    return False
+                num_arrays = len(self.cache.past_names)
+                for key in data.files:
+                    if key.endswith("/tokens"):
+                        name = key[:-len("/tokens")]
+                        arrays = [data[f"{name}/{j}"].astype(self.cache.dtype) for j in range(num_arrays)]
+                        self.snapshots[name] = (data[key], arrays)
+            return True
+        except Exception as e:
+            print(f"Could not load the kv snapshots: {e}")
+            return False
+
+    def step(self, input_ids):
+        """ Runs the new tokens `input_ids` (batch, seq) through the model & returns the logits """
+        new_tokens = input_ids.shape[-1]
+        start = self.cache.length
+        self.reserve(start + new_tokens)
+        feed = {
+            "input_ids": np.ascontiguousarray(input_ids, dtype=np.int64),
+            "position_ids": np.ascontiguousarray(self.pos_buf[:, start:start + new_tokens]),
+        }
+        if self.use_att_mask:
+            feed["attention_mask"] = np.ascontiguousarray(self.mask_buf[:, :start + new_tokens])
+        logits = self.run(feed, new_tokens)
+        if self.prefix_cache:
+            self.tokens.extend(input_ids[0].tolist())
+        return logits
+
+    def run(self, feed, new_tokens):
+        if self.binding is not None:
+            try:
+                return self.run_bound(feed, new_tokens)
+            except Exception as e:
+                print(f"IOBinding run failed, using session.run: {e}")
+                self.binding = None
+        return self.run_plain(feed, new_tokens)
+
+    def run_bound(self, feed, new_tokens):
+        binding = self.binding
+        binding.clear_binding_inputs()
+        binding.clear_binding_outputs()
+        for name, value in feed.items():
+            binding.bind_cpu_input(name, value)
+        # logits are bound first, so they are the first of the copied outputs
+        reuse_logits = new_tokens == 1 and self.logits_buf is not None
+        if reuse_logits:
+            binding.bind_output(self.logits_name, "cpu", 0, self.logits_buf.dtype, self.logits_buf.shape, self.logits_buf.ctypes.data)
+        else:
+            binding.bind_output(self.logits_name, "cpu")
+        self.cache.bind(binding, new_tokens)
+        self.session.run_with_iobinding(binding)
+        self.cache.advance(new_tokens)
+        if reuse_logits:
+            return self.logits_buf
+        logits = binding.get_outputs()[0].numpy() # only the logits are copied
+        if self.logits_buf is None:
+            self.logits_buf = np.empty((self.batch_size, 1, logits.shape[-1]), dtype=logits.dtype)
+        return logits
+
+    def run_plain(self, feed, new_tokens):
+        feed.update(self.cache.feeds())
+        logits, *present_key_values = self.session.run(None, feed)
+        self.cache.store(present_key_values, new_tokens)
+        return logits
+
+# ================== SAMPLER ==================
+class Sampler:
+    """
+    Next token sampler working in float32 on reused scratch buffers. Top-k is applied first (argpartition),
+    so the softmax, sort & top-p cutoff only run over the k survivors instead of the whole vocabulary.
+    The repetition & frequency penalties count the tokens generated since the last `reset`.
+    """
+
+    def __init__(self, seed=None) -> None:
+        self.rng = np.random.default_rng(seed)
+        self.scores = None # penalized logits of the current step
+        self.counts = None # times every token was generated
+        self.seen = [] # token ids with a count, so the penalties only touch those
+
+    def reset(self, seed=None):
+        if self.counts is not None and self.seen:
+            self.counts[self.seen] = 0
+        self.seen = []
+        if seed is not None:
+            self.rng = np.random.default_rng(seed)
+
+    def prepare(self, vocab_size):
+        if self.scores is None or len(self.scores) != vocab_size:
+            self.scores = np.empty(vocab_size, dtype=np.float32)
+            self.counts = np.zeros(vocab_size, dtype=np.int32)
+            self.seen = []
+
+    def accept(self, token_id):
+        if self.counts[token_id] == 0:
+            self.seen.append(token_id)
+        self.counts[token_id] += 1
+
+    def load_scores(self, logits, repetition_penalty=1.0, frequency_penalty=0.0):
+        """ Copies the last logits row into the scratch buffer & applies the penalties """
+        logits = logits.reshape(-1, logits.shape[-1])[-1]
+        self.prepare(len(logits))
+        scores = self.scores
+        np.copyto(scores, logits, casting="same_kind")
+        if self.seen and (repetition_penalty != 1.0 or frequency_penalty):
+            ids = np.array(self.seen, dtype=np.int64)
+            vals = scores[ids]
+            if repetition_penalty != 1.0:
+                vals = np.where(vals > 0, vals / repetition_penalty, vals * repetition_penalty)
+            if frequency_penalty:
+                vals = vals - frequency_penalty * self.counts[ids]
+            scores[ids] = vals
+        return scores
+
+    def distribution(self, logits, temperature=0.2, top_k=40, top_p=0.9, repetition_penalty=1.0, frequency_penalty=0.0):
+        """ Returns (token ids, probs) of the tokens left after top-k & top-p, most probable first """
+        scores = self.load_scores(logits, repetition_penalty, frequency_penalty)
+        vocab_size = len(scores)
+        k = min(int(top_k), vocab_size) if top_k and top_k > 0 else vocab_size
+        if k < vocab_size:
+            ids = np.argpartition(scores, vocab_size - k)[vocab_size - k:]
+        else:
+            ids = np.arange(vocab_size)
+        vals = scores[ids]
+        order = np.argsort(-vals, kind="stable")
+        ids = ids[order]
+        vals = vals[order]
+        # softmax over the survivors
+        vals -= vals[0]
+        vals /= max(temperature, 1e-5)
+        np.exp(vals, out=vals)
+        vals /= vals.sum()
+        if top_p < 1.0:
+            # keep the smallest head whose mass goes over top_p
+            cutoff = int(np.searchsorted(np.cumsum(vals), top_p, side="right")) + 1
+            if cutoff < len(vals):
+                ids = ids[:cutoff]
+                vals = vals[:cutoff] / vals[:cutoff].sum()
+        return ids, vals
+
+    def sample(self, logits, temperature=0.2, top_k=40, top_p=0.9, repetition_penalty=1.0, frequency_penalty=0.0, greedy=False):
+        """ Draws the next token id from the last logits row """
+        if greedy or temperature <= 0:
+            token_id = int(np.argmax(self.load_scores(logits, repetition_penalty, frequency_penalty)))
+        else:
+            ids, probs = self.distribution(logits, temperature, top_k, top_p, repetition_penalty, frequency_penalty)
+            token_id = self.draw(ids, probs)
+        self.accept(token_id)
+        return token_id
+
+    def draw(self, ids, probs):
+        pos = int(np.searchsorted(np.cumsum(probs), self.rng.random() * probs.sum(), side="right"))
+        return int(ids[min(pos, len(ids) - 1)])
+
+# ================== CONTEXT WINDOW ==================
+class ContextBuilder:
+    """
+    Picks the messages of a prompt so that the prompt & the answer fit in the model context. The system
+    prompt & the new message always go in (the new one cut in the middle if it is too long), then as much
+    history as fits, newest first. The token counts of the formatted messages are cached, so the history
+    is not tokenized again on every turn.
+    """
+
+    def __init__(self, tokenizer, format_message, max_context=2048, overhead=0, min_new_tokens=64, max_cached=4096) -> None:
+        self.tokenizer = tokenizer
+        self.format_message = format_message # message dict -> its chat template text
+        self.max_context = max_context
+        self.overhead = overhead # template tokens outside the messages (bos, generation prompt)
+        self.min_new_tokens = min_new_tokens
+        self.max_cached = max_cached
+        self.counts = {} # (role, content): tokens
+
+    def count(self, message):
+        key = (message["role"], message["content"])
+        num_tokens = self.counts.get(key)
+        if num_tokens is None:
+            if len(self.counts) >= self.max_cached:
+                self.counts.clear()
+            num_tokens = len(self.tokenizer.encode(self.format_message(message), add_special_tokens=False).ids)
+            self.counts[key] = num_tokens
+        return num_tokens
+
+    def fit_message(self, message, max_tokens):
+        """ Cuts the middle of the content out so the message takes at most `max_tokens` """
+        extra = self.count(message) - max_tokens
+        if extra <= 0:
+            return message
+        ids = self.tokenizer.encode(message["content"], add_special_tokens=False).ids
+        keep = max(len(ids) - extra - 8, 0) # a few tokens of slack for the joint
+        head = keep // 4
+        tail = keep - head
+        content = self.tokenizer.decode(ids[:head]) + "\n...\n" + self.tokenizer.decode(ids[len(ids) - tail:])
+        print(f"Context: cut {len(ids) - keep} tokens out of a {len(ids)} tokens message")
+        return {"role": message["role"], "content": content}
+
+    def build(self, messages, max_new_tokens):
+        """
+        `messages` starts with the system prompt & ends with the new message.
+        Returns the messages to send & the number of tokens left for the answer.
+        """
+        system, history, last = messages[0], messages[1:-1], messages[-1]
+        available = self.max_context - self.overhead - self.count(system)
+        new_tokens = min(max_new_tokens, available - self.count(last))
+        new_tokens = max(new_tokens, min(self.min_new_tokens, max_new_tokens))
+        last = self.fit_message(last, max(available - new_tokens, 1))
+        budget = available - new_tokens - self.count(last)
+        kept = []
+        for message in reversed(history):
+            num_tokens = self.count(message)
+            if num_tokens > budget:
+                break
+            kept.append(message)
+            budget -= num_tokens
+        return [system] + kept[::-1] + [last], new_tokens
+
+# ================== DETOKENIZER ==================
+class StreamDetokenizer:
+    """
+    Incremental decoding of a token stream. A token is decoded together with the few tokens before it
+    (so BPE/sentencepiece spaces come out right) & text is only emitted once it is complete UTF-8,
+    a token holding part of a multi-byte character waits for the rest.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens=True) -> None:
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.reset()
+
+    def reset(self):
+        self.tokens = []
+        self.prefix_offset = 0 # start of the context window
+        self.read_offset = 0 # tokens before this are emitted
+
+    def decode(self, tokens):
+        return self.tokenizer.decode(tokens, skip_special_tokens=self.skip_special_tokens)
+
+    def add(self, token_id):
+        """ Adds a token & returns the newly completed text (may be empty) """
+        self.tokens.append(int(token_id))
+        prefix_text = self.decode(self.tokens[self.prefix_offset:self.read_offset])
+        new_text = self.decode(self.tokens[self.prefix_offset:])
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.tokens)
+            return new_text[len(prefix_text):]
+        return ""
+
+    def flush(self):
+        """ Returns whatever is still held back, at the end of the stream """
+        prefix_text = self.decode(self.tokens[self.prefix_offset:self.read_offset])
+        new_text = self.decode(self.tokens[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.tokens)
+        return new_text[len(prefix_text):]
+
+# ================== SPECULATIVE DECODING ==================
+def prob_of(ids, probs, token_id):
+    hit = np.flatnonzero(ids == token_id)
+    return float(probs[hit[0]]) if len(hit) else 0.0
+
+def residual_probs(ids, probs, draft_dist, token_id):
+    """ max(0, p - q) over the target candidates, q is the draft distribution (a single token if None) """
+    residual = probs.copy()
+    if draft_dist is None:
+        residual[ids == token_id] = 0.0
+    else:
+        q_ids, q_probs = draft_dist
+        order = np.argsort(q_ids)
+        q_ids = q_ids[order]
+        pos = np.minimum(np.searchsorted(q_ids, ids), len(q_ids) - 1)
+        found = q_ids[pos] == ids
+        residual[found] -= q_probs[order][pos[found]]
+        np.maximum(residual, 0.0, out=residual)
+    return residual
+
+def accept_draft(sampler, logits, draft, draft_dists, sample_kw, greedy=False):
+    """
+    Verifies the drafted tokens against the target logits (1, len(draft) + 1, vocab) of one decoder step.
+    A draft token is kept with probability min(1, p/q), the first rejected one is replaced by a token drawn
+    from max(0, p - q), so the output follows the target distribution. When every draft is kept, one more
+    token is drawn from the last logits. Returns the kept drafts followed by that one new token.
+    """
+    greedy = greedy or sample_kw.get("temperature", 1.0) <= 0
+    out = []
+    for i, token_id in enumerate(draft):
+        row = logits[:, i, :]
+        if greedy:
+            target_id = int(np.argmax(sampler.load_scores(row, sample_kw.get("repetition_penalty", 1.0), sample_kw.get("frequency_penalty", 0.0))))
+            sampler.accept(target_id)
+            out.append(target_id)
+            if target_id != token_id:
+                return out
+            continue
+        ids, probs = sampler.distribution(row, **sample_kw)
+        p = prob_of(ids, probs, token_id)
+        draft_dist = None if draft_dists is None else draft_dists[i]
+        q = 1.0 if draft_dist is None else prob_of(*draft_dist, token_id)
+        if q > 0 and sampler.rng.random() * q < p:
+            sampler.accept(token_id)
+            out.append(token_id)
+            continue
+        residual = residual_probs(ids, probs, draft_dist, token_id)
+        target_id = sampler.draw(ids, residual) if residual.sum() > 0 else sampler.draw(ids, probs)
+        sampler.accept(target_id)
+        out.append(target_id)
+        return out
+    out.append(sampler.sample(logits[:, len(draft), :], greedy=greedy, **sample_kw))
+    return out
+
+class DraftModel:
+    """
+    Small model sharing the tokenizer of the target, it proposes the next tokens with its own Decoder
+    (whose prefix cache keeps it in sync with the conversation).
+    """
+
+    def __init__(self, decoder, seed=None) -> None:
+        self.decoder = decoder
+        self.sampler = Sampler(seed)
+
+    def propose(self, context, num_tokens, sample_kw, greedy=False):
+        """ Returns the drafted tokens & the distribution each one was drawn from (None when greedy) """
+        # the same settings as the target sampler, missing ones take the Sampler defaults
+        sample_kw = {key: sample_kw[key] for key in ("temperature", "top_k", "top_p") if key in sample_kw}
+        greedy = greedy or sample_kw.get("temperature", 0.2) <= 0
+        self.decoder.reserve(len(context) + num_tokens)
+        # only the tokens added since the last draft are run
+        logits = self.decoder.prefill(np.array([context], dtype=np.int64), quiet=True)
+        self.sampler.reset()
+        draft, dists = [], []
+        for i in range(num_tokens):
+            if i > 0:
+                logits = self.decoder.step(np.array([[draft[-1]]], dtype=np.int64))
+            row = logits[:, -1, :]
+            if greedy:
+                draft.append(int(np.argmax(row)))
+                continue
+            # the penalties are left out, the verification only needs the distribution actually used
+            ids, probs = self.sampler.distribution(row, **sample_kw)
+            draft.append(self.sampler.draw(ids, probs))
+            dists.append((ids, probs))
+        return draft, (None if greedy else dists)
+
+class PromptLookup:
+    """
+    Draft-free proposer: finds the latest earlier occurrence of the last `ngram` tokens in the
+    conversation (prompt included) & proposes the tokens which followed it. It pays off when the answer
+    copies spans of the prompt, like the document context of a RAG question.
+    """
+
+    def __init__(self, ngram=3, min_ngram=1) -> None:
+        self.ngram = ngram
+        self.min_ngram = min_ngram
+
+    def propose(self, context, num_tokens, sample_kw=None, greedy=False):
+        """ Returns the proposed tokens, None as the distribution because they are not sampled """
+        tokens = np.asarray(context, dtype=np.int64)
+        for n in range(min(self.ngram, len(tokens) - 1), self.min_ngram - 1, -1):
+            # windows over all but the last token, so a match is never the tail itself & has a continuation
+            windows = np.lib.stride_tricks.sliding_window_view(tokens[:-1], n)
+            matches = np.flatnonzero((windows == tokens[-n:]).all(axis=1))
+            if len(matches):
+                start = int(matches[-1]) + n
+                return tokens[start:start + num_tokens].tolist(), None
+        return [], None
+
+# ================== GENERATION ==================
+def generate_batch(decoder, prompts, max_new_tokens, sample_kw, eos_token_ids=(), seed=None):
+    """
+    Generates the answers of several prompts in one decode loop, for offline bulk jobs. The decoder has
+    to be made with batch_size=len(prompts). The prompts are left padded to the same length, every row
+    has its own Sampler & stops at its own EOS (a finished row keeps running until all are done, its
+    output is ignored). `sample_kw` is one dict (Sampler.sample keywords, greedy included) or one per row.
+    Returns the generated token ids of every row, without the EOS.
+    """
+    batch_size = len(prompts)
+    if batch_size != decoder.batch_size:
+        raise ValueError(f"The decoder batch size is {decoder.batch_size}, got {batch_size} prompts")
+    row_kw = list(sample_kw) if isinstance(sample_kw, (list, tuple)) else [sample_kw] * batch_size
+    samplers = [Sampler(None if seed is None else seed + row) for row in range(batch_size)]
+    max_len = max(len(prompt) for prompt in prompts)
+    input_ids = np.zeros((batch_size, max_len), dtype=np.int64)
+    for row, prompt in enumerate(prompts):
+        input_ids[row, max_len - len(prompt):] = prompt
+    if decoder.max_len:
+        # every row runs for the longest prompt + the answer, which has to stay in the model positions
+        max_new_tokens = min(max_new_tokens, decoder.max_len - max_len)
+        if max_new_tokens <= 0:
+            raise ValueError(f"The longest prompt ({max_len} tokens) fills the model context ({decoder.max_len})")
+    decoder.reset()
+    decoder.reserve(max_len + max_new_tokens)
+    decoder.set_padding([max_len - len(prompt) for prompt in prompts])
+    outputs = [[] for _ in range(batch_size)]
+    done = np.zeros(batch_size, dtype=bool)
+    next_ids = input_ids[:, -1:].copy()
+    logits = decoder.step(input_ids)
+    for i in range(max_new_tokens):
+        if i > 0:
+            logits = decoder.step(next_ids)
+        for row in np.flatnonzero(~done):
+            token_id = samplers[row].sample(logits[row, -1], **row_kw[row])
+            if token_id in eos_token_ids:
+                done[row] = True
+                continue
+            outputs[row].append(token_id)
+            next_ids[row, 0] = token_id
+        if done.all():
+            break
+    decoder.reset()
+    return outputs
+
+def generate(decoder, sampler, input_ids, max_new_tokens, sample_kw, greedy=False, proposer=None, draft_tokens=4, stats=None):
+    """
+    Yields the generated token ids one by one. With a proposer, its draft is checked by a single decoder
+    step over all the drafted tokens & the rejected tail is cut from the kv cache.
+    `stats` (dict) collects the drafted & accepted token counts.
+    """
+    decoder.reserve(input_ids.shape[-1] + max_new_tokens + draft_tokens)
+    logits = decoder.prefill(input_ids)
+    sampler.reset()
+    token_id = sampler.sample(logits[:, -1, :], greedy=greedy, **sample_kw)
+    context = input_ids[0].tolist() + [token_id]
+    produced = 1
+    yield token_id
+    while produced < max_new_tokens:
+        num_draft = min(draft_tokens, max_new_tokens - produced - 1) if proposer is not None else 0
+        draft, dists = proposer.propose(context, num_draft, sample_kw, greedy) if num_draft > 0 else ([], None)
+        if draft:
+            start = decoder.cache.length
+            logits = decoder.step(np.array([[token_id] + draft], dtype=np.int64))
+            new_ids = accept_draft(sampler, logits, draft, dists, sample_kw, greedy)
+            # the last new token is not in the cache yet, it is run with the next draft
+            decoder.truncate(start + len(new_ids))
+            if stats is not None:
+                stats["drafted"] = stats.get("drafted", 0) + len(draft)
+                stats["accepted"] = stats.get("accepted", 0) + len(new_ids) - 1
+        else:
+            logits = decoder.step(np.array([[token_id]], dtype=np.int64))
+            new_ids = [sampler.sample(logits[:, -1, :], greedy=greedy, **sample_kw)]
+        for token_id in new_ids:
+            context.append(token_id)
+            produced += 1
+            yield token_id
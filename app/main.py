@@ -35,11 +35,6 @@ from kivymd.uix.button import MDFlatButton, MDFloatingActionButton
 from kivymd.uix.filemanager import MDFileManager
 from kivymd.uix.toolbar import MDTopAppBar # due to linux package issue
 
-# app brains
-import numpy as np
-from onnxruntime import InferenceSession
-from tokenizers import Tokenizer
-
 # other public modules
 from m2r2 import convert
 
@@ -56,6 +51,9 @@ from screens.docs_screen import DocsScreen
 from screens.camera_screen import CameraScreen
 from screens.voice_screen import VoiceScreen
 from docRag import LocalRag
+from chatEngine import ChatEngine, SYSTEM_PROMPTS, DEFAULT_LLM_MODELS, default_providers
+from ortSession import SESSION_POOL
+from inferenceWorker import InferenceWorker, CancelToken, PRIORITY_RETRIEVAL, PRIORITY_GENERATION, PRIORITY_BACKGROUND
 
 # IMPORTANT: Set this property for keyboard behavior
 Window.softinput_mode = "below_target"
@@ -73,6 +71,13 @@ else:
 kv_file_path = os.path.join(base_path, 'main_layout.kv')
 noto_font = os.path.join(base_path, "data/fonts/NotoSans-Merged.ttf")
 
+# the streamed answer is pushed to the UI at most this often (seconds)
+STREAM_FLUSH_SECS = 0.05
+
+def on_ui_thread(fn):
+    """ Dispatcher of the worker & rag callbacks: runs `fn` on the kivy main thread """
+    Clock.schedule_once(lambda dt: fn())
+
 ## debug if any
 
 ## The KivyMD app
@@ -86,6 +91,8 @@ class OnLlmApp(MDApp):
     gen_topk = NumericProperty(20)
     gen_topp = NumericProperty(0.85)
     gen_temp = NumericProperty(0.15)
+    gen_rep_penalty = NumericProperty(1.0)
+    gen_freq_penalty = NumericProperty(0.0)
 
     # accelerator (UI only)
     gen_accel = StringProperty("CPU")
@@ -95,12 +102,16 @@ class OnLlmApp(MDApp):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         Window.bind(on_keyboard=self.events)
-        self.process = None
-        self.stop = False
-        self.decoder_session = None
+        # every onnx call (llm, rag retrieval, model loading) runs on this worker, one job at a time
+        self.worker = InferenceWorker(dispatch=on_ui_thread)
+        self.chat_token = CancelToken() # cancels the current question (retrieval + answer)
+        self.engine = None # model loading & generation (chatEngine), made in on_start
         self.rag_sess = None
         self.rag_ok = False
         self.doc_path = None
+        self.tmp_wait = None
+        self.index_wait = None
+        self.rag_live = False
         self.file_permission = False
         self.selected_llm = ""
         self.to_download_model = "na"
@@ -154,17 +165,7 @@ class OnLlmApp(MDApp):
                 pass
             Clock.schedule_once(self._preview_init, 0.2)
             return
-        self.llm_models = {
-            "smollm2-135m": {
-                "name": "smollm2-135m",
-                "url": "https://github.com/daslearning-org/OnLLM/releases/download/vOnnxModels/smollm2-135m.tar.gz",
-                "size": "95MB",
-                "platform": "android", # means runs on all
-                "tokens": ["", "<|im_start|>", "<|im_end|>"],
-                "eos_ids": ["<|endoftext|>"],
-                "att_mask": True
-            }
-        }
+        self.llm_models = {name: dict(config) for name, config in DEFAULT_LLM_MODELS.items()}
         self.rag_models = {
             "all-MiniLM-L6-V2": {
                 "name": "all-MiniLM-L6-V2",
@@ -224,6 +225,7 @@ class OnLlmApp(MDApp):
         os.makedirs(self.op_dir, exist_ok=True)
         os.makedirs(self.config_dir, exist_ok=True)
         os.makedirs(self.in_dir, exist_ok=True)
+        self.engine = ChatEngine(self.model_dir, self.llm_models, self.config_dir)
         # update models from local model config
         self.extra_models_config = os.path.join(self.config_dir, 'extra_models.json')
         if os.path.exists(self.extra_models_config):
@@ -328,15 +330,19 @@ class OnLlmApp(MDApp):
         # Otherwise: normal RAG document flow
         self.doc_path = path
         print(f"\n**Selected doc path: {self.doc_path}")  # debug
-        self.tmp_wait = TempSpinWait()
-        self.tmp_wait.text = "Analyzing the doc, please wait..."
-        self.chat_history_id.add_widget(self.tmp_wait)
+        self.index_wait = TempSpinWait()
+        self.index_wait.text = "Analyzing the doc, please wait..."
+        self.rag_live = False
+        self.chat_history_id.add_widget(self.index_wait)
         if not self.rag_sess:
             self.rag_sess = LocalRag(
                 model_dir=self.model_dir,
-                config_dir=self.config_dir
+                config_dir=self.config_dir,
+                dispatch=on_ui_thread,
             )
-        Thread(target=self.rag_sess.start_rag_onnx_sess, args=(self.doc_path, self.rag_init_callback), daemon=True).start()
+        # indexing keeps its own thread: it takes the rag lock page by page, so questions on the pages
+        # already indexed are answered (through the worker) while it runs
+        Thread(target=self.rag_sess.start_rag_onnx_sess, args=(self.doc_path, self.rag_init_callback, self.rag_progress_callback), daemon=True).start()
         
         # Auto-navigate to chat after doc processing (if opened from docs_screen)
         if getattr(self, "doc_picker_source", "") == "docs":
@@ -755,6 +761,8 @@ class OnLlmApp(MDApp):
         root.add_widget(row("TopK", 1, 100, 1, "gen_topk", fmt="{}"))
         root.add_widget(row("TopP", 0.10, 1.00, 0.01, "gen_topp", fmt="{:.2f}", is_float=True))
         root.add_widget(row("Temperature", 0.0, 1.5, 0.05, "gen_temp", fmt="{:.2f}", is_float=True))
+        root.add_widget(row("Repetition penalty", 1.0, 2.0, 0.05, "gen_rep_penalty", fmt="{:.2f}", is_float=True))
+        root.add_widget(row("Frequency penalty", 0.0, 2.0, 0.05, "gen_freq_penalty", fmt="{:.2f}", is_float=True))
 
         # accelerator toggle row (UI-only, matches screenshot)
         accel_row = MDBoxLayout(orientation="horizontal", adaptive_height=True, spacing=dp(10), padding=(0, dp(6), 0, 0))
@@ -904,7 +912,14 @@ class OnLlmApp(MDApp):
             self.root.get_screen("chatbot_screen").ids.llm_menu.text = self.selected_llm
         except Exception:
             pass
-        self.init_onnx_sess(self.selected_llm)
+        self.load_llm(self.selected_llm)
+
+    def load_llm(self, llm):
+        """ Loads the model on the inference worker, a running answer is stopped first """
+        self.chat_token.cancel()
+        self.remove_tmp_wait()
+        self.is_llm_running = False
+        self.worker.submit(self.init_onnx_sess, llm, priority=PRIORITY_RETRIEVAL)
 
     def token_menu_callback(self, text):
         if self.token_menu:
@@ -918,33 +933,68 @@ class OnLlmApp(MDApp):
         if token_menu_widget:
             token_menu_widget.text = text
 
-    def rag_init_callback(self, check):
+    def set_rag_btn(self, doc_mode):
         try:
             rag_btn = self.root.get_screen("chatbot_screen").ids.get("rag_doc")
         except Exception:
             rag_btn = None
+        if rag_btn:
+            rag_btn.icon = "file-document-remove" if doc_mode else "file-document-plus"
+            rag_btn.icon_color = "orange" if doc_mode else "gray"
+
+    def rag_progress_callback(self, page_no, total_pages, num_chunks):
+        if self.index_wait:
+            self.index_wait.text = f"Analyzing the doc, page {page_no}/{total_pages}..."
+        if num_chunks > 0 and not self.rag_live:
+            # the indexed pages can already be queried
+            self.rag_live = True
+            self.rag_ok = True
+            self.set_rag_btn(True)
+
+    def rag_init_callback(self, check):
         if check:
             self.rag_ok = True
-            if rag_btn:
-                rag_btn.icon = "file-document-remove"
-                rag_btn.icon_color = "orange"
+            # load the embedder & search matrix now, not on the first question
+            self.worker.submit(self.rag_sess.warmup, priority=PRIORITY_BACKGROUND)
+            self.set_rag_btn(True)
             self.show_toast_msg("Document processed, you can ask quesions on your DOC")
             self.show_toast_msg("📄 Doc mode ON: answers will use your document")
         else:
+            self.rag_ok = False
+            self.set_rag_btn(False)
             self.show_toast_msg("Document processed failed, your answer will be generic", is_error=True)
-        if self.tmp_wait:
-            self.chat_history_id.remove_widget(self.tmp_wait)
-            self.tmp_wait = None
+        if self.index_wait:
+            self.chat_history_id.remove_widget(self.index_wait)
+            self.index_wait = None
 
     def rag_qa_callback(self, prompt):
         self.send_message(button_instance=None, chat_input_widget=None, callback=True, rag_usr_prompt=prompt)
 
+    def rag_retrieval_done(self, future, token):
+        if token.cancelled or future.cancelled():
+            return
+        if future.exception() is not None:
+            self.remove_tmp_wait()
+            self.is_llm_running = False
+            self.show_toast_msg(f"Could not read the doc: {future.exception()}", is_error=True)
+            return
+        self.is_llm_running = False
+        self.rag_qa_callback(future.result())
+
+    def remove_tmp_wait(self):
+        """ Removes the "reading the doc" spinner (the retrieval callback is skipped once cancelled) """
+        if self.tmp_wait:
+            self.chat_history_id.remove_widget(self.tmp_wait)
+            self.tmp_wait = None
+
     def stop_chat(self):
-        self.stop = True
+        self.chat_token.cancel()
+        self.remove_tmp_wait()
         self.is_llm_running = False
 
     def new_chat(self):
-        self.stop = True
+        self.chat_token.cancel()
+        self.remove_tmp_wait()
         self.is_llm_running = False
         self.chat_history_id.clear_widgets()
         self.messages = []
@@ -987,35 +1037,33 @@ class OnLlmApp(MDApp):
         if self.is_llm_running:
             self.show_toast_msg("Please wait for the current response", is_error=True)
             return
+        if not callback:
+            # a fresh token per question, the retrieval & its answer share it
+            self.chat_token = CancelToken()
+        token = self.chat_token
         if callback:
             user_message = rag_usr_prompt.strip()
             llm_context = {
                 "role": "system",
-                "content": (
-                    "Answer ONLY using the provided document context. "
-                    "If the answer is not in the context, say: 'Not found in the document.' "
-                    "Do not add extra facts."
-                )
+                "content": SYSTEM_PROMPTS["rag"]
             }
-            if self.tmp_wait:
-                self.chat_history_id.remove_widget(self.tmp_wait)
-                self.tmp_wait = None
+            self.remove_tmp_wait()
         else:
             user_message = chat_input_widget.text.strip()
-            if self.rag_ok:
-                Thread(target=self.rag_sess.get_rag_prompt, args=(user_message,self.rag_qa_callback), daemon=True).start()
+            if self.rag_ok and user_message:
+                self.worker.submit(
+                    self.rag_sess.get_rag_prompt, user_message,
+                    priority=PRIORITY_RETRIEVAL, token=token,
+                    callback=lambda future: self.rag_retrieval_done(future, token),
+                )
+                self.is_llm_running = True
                 self.tmp_wait = TempSpinWait()
                 self.tmp_wait.text = "Please wait while reading the doc..."
                 self.chat_history_id.add_widget(self.tmp_wait)
                 #return
             llm_context = {
                 "role": "system",
-                "content": (
-                    "You are a concise and accurate assistant. "
-                    "If you are not sure, say you don't know. "
-                    "Do not invent facts. "
-                    "Use bullet points when helpful."
-                )
+                "content": SYSTEM_PROMPTS["chat"]
             }
             chat_input_widget.text = ""
         if user_message:
@@ -1044,195 +1092,69 @@ class OnLlmApp(MDApp):
                 }
                 msg_to_send.append(rag_msg)
             else:
-                msg_to_send.extend(self.messages[-6:]) # taking last six messages only
-            ollama_thread = Thread(target=self.chat_with_llm, args=(msg_to_send,), daemon=True)
-            ollama_thread.start()
+                msg_to_send.extend(self.messages) # the context builder keeps what fits in the model context
+            self.worker.submit(
+                self.chat_with_llm, msg_to_send, callback, token,
+                priority=PRIORITY_GENERATION, token=token,
+                callback=lambda future: self.chat_done(future, token),
+            )
             self.is_llm_running = True
         else:
             self.show_toast_msg("Please type a message!", is_error=True)
 
-    def apply_chat_template(self, messages, add_generation_prompt=False, tokenize=True, return_tensors="np"):
-        init_prompt = self.llm_models[self.selected_llm]['tokens'][0]
-        start_prompt = self.llm_models[self.selected_llm]['tokens'][1]
-        end_prompt = self.llm_models[self.selected_llm]['tokens'][2]
-        prompt = init_prompt
-        for msg in messages:
-            role = msg["role"]
-            content = msg["content"].strip()  # Strip for cleanliness
-            if role == "system":
-                prompt += f"{start_prompt}system\n{content}{end_prompt}\n"
-            elif role == "user":
-                prompt += f"{start_prompt}user\n{content}{end_prompt}\n"
-            elif role == "assistant" or role == "model":
-                prompt += f"{start_prompt}assistant\n{content}{end_prompt}\n"
-
-        if add_generation_prompt:
-            prompt += f"{start_prompt}assistant\n"
-
-        if not tokenize:
-            return prompt
-
-        # Tokenize (encode to IDs)
-        encoding = self.tokenizer.encode(prompt, add_special_tokens=False)  # False to avoid extra BOS if already added
-        token_ids = encoding.ids
-
-        if return_tensors == "np":
-            input_ids = np.array([token_ids], dtype=np.int64)  # Batch size 1
-        else:
-            input_ids = np.array(token_ids, dtype=np.int64)
-
-        # Return dict like HF (only input_ids, as in your code)
-        return {"input_ids": input_ids}
-
     def init_onnx_sess(self, llm="smollm2-135m"):
-        path_to_model = os.path.join(self.model_dir, llm)
-        arm_android = False
+        """ Worker job: loads the model in the chat engine & reports the load time """
         try:
-            import platform as corept
-            cpu_arch = corept.machine()
-            if 'arm' in cpu_arch.lower() or 'aarch' in cpu_arch.lower():
-                arm_android = True
-        except Exception as e:
-            print(f"Error in CPU architecture check: {e}")
-        android_providers = [
-            'XnnpackExecutionProvider',
-            'CPUExecutionProvider',
-        ]
-        desktop_providers = [
-            'CUDAExecutionProvider',
-            'CPUExecutionProvider'
-        ]
-        try:
-            # Load config & token jsons
-            # Load config with json
-            with open(f"{path_to_model}/config.json", "r") as f:
-                config_data = json.load(f)
-            self.tokenizer = Tokenizer.from_file(f"{path_to_model}/tokenizer.json")
-            self.num_key_value_heads = config_data["num_key_value_heads"]
-            self.head_dim = config_data["head_dim"]
-            self.num_hidden_layers = config_data["num_hidden_layers"]
-            primary_eos = self.llm_models[self.selected_llm]["tokens"][2]
-            other_eos = self.llm_models[self.selected_llm]["eos_ids"]
-            self.eos_token_ids = [
-                self.tokenizer.token_to_id(primary_eos),
-            ]
-            for eos in other_eos:
-                eos_item = self.tokenizer.token_to_id(str(eos))
-                self.eos_token_ids.append(eos_item)
-
-            if platform == "android" or arm_android:
-                self.decoder_session = InferenceSession(f"{path_to_model}/onnx/model_int8.onnx", providers=android_providers)
-            else:
-                self.decoder_session = InferenceSession(f"{path_to_model}/onnx/model_int8.onnx", providers=desktop_providers)
-            print("Using:", self.decoder_session.get_providers())
-            self.process = True
+            load_msg = self.engine.load(llm, default_providers(android=platform == "android"))
+            Clock.schedule_once(lambda dt: self.show_toast_msg(load_msg))
         except Exception as e:
             print(f"Onnx init error: {e}")
-            self.show_toast_msg(f"Onnx init error: {e}", is_error=True)
-
-    def sample_logits(self, logits, temperature=0.2, top_p=0.9, top_k=40):
-        logits = logits.astype(np.float64)
-        logits = logits / max(temperature, 1e-5)
-
-        # softmax probs
-        exp_logits = np.exp(logits - np.max(logits, axis=-1, keepdims=True))
-        probs = exp_logits / np.sum(exp_logits, axis=-1, keepdims=True)
-
-        # top-k filter
-        if top_k and top_k > 0:
-            idx = np.argpartition(probs[0], -top_k)[-top_k:]
-            mask = np.zeros_like(probs[0], dtype=bool)
-            mask[idx] = True
-            probs[0][~mask] = 0.0
-            probs = probs / (np.sum(probs, axis=-1, keepdims=True) + 1e-12)
-
-        # nucleus (top-p)
-        sorted_indices = np.argsort(probs[0])[::-1]
-        sorted_probs = probs[0, sorted_indices]
-        cumulative_probs = np.cumsum(sorted_probs)
-
-        cutoff = np.where(cumulative_probs > top_p)[0]
-        cutoff = cutoff[0] + 1 if len(cutoff) > 0 else len(sorted_probs)
-
-        probs[0, sorted_indices[cutoff:]] = 0.0
-        probs = probs / (np.sum(probs, axis=-1, keepdims=True) + 1e-12)
+            Clock.schedule_once(lambda dt, msg=f"Onnx init error: {e}": self.show_toast_msg(msg, is_error=True))
 
-        next_token = np.random.choice(len(probs[0]), p=probs[0])
-        return np.array([[next_token]], dtype=np.int64)
-
-    def chat_with_llm(self, messages):
-        if not self.process:
+    def chat_done(self, future, token):
+        """ Runs on the UI thread when the answer job ended (skipped if the chat was stopped) """
+        if token.cancelled or future.cancelled():
+            return
+        final_result = future.result()
+        if final_result is None:
             self.is_llm_running = False
-            Clock.schedule_once(lambda dt: self.show_toast_msg("Onnx Session is not ready", is_error=True))
+            if self.tmp_txt:
+                self.chat_history_id.remove_widget(self.tmp_txt)
+            self.show_toast_msg("Onnx Session is not ready", is_error=True)
             return
+        self.final_llm_result(final_result)
+
+    def chat_with_llm(self, messages, doc_qa=False, token=None):
+        """ Worker job: generates the answer & returns the final message (None if no model is loaded) """
+        if self.engine is None or not self.engine.ready:
+            return None
+        token = token or CancelToken()
         # start onnx llm inference
-        self.stop = False
         final_result = {"role": "init", "content": "Chat initial"}
         final_txt = ""
         try:
-            inputs = self.apply_chat_template(messages, add_generation_prompt=True, tokenize=True, return_tensors="np")
-            input_token_count = inputs['input_ids'].shape[-1]
-            print(f"Input token count: {input_token_count}")
-            ## Prepare decoder inputs
-            input_ids = inputs['input_ids']
-            batch_size = inputs['input_ids'].shape[0]
-            past_key_values = {
-                f'past_key_values.{layer}.{kv}': np.zeros(
-                    [batch_size, self.num_key_value_heads, 1, self.head_dim],
-                    dtype=np.float32
-                )[:, :, :0, :]  # Slice back to 0-length safely
-                for layer in range(self.num_hidden_layers)
-                for kv in ('key', 'value')
+            sample_kw = {
+                "temperature": float(self.gen_temp),
+                "top_k": int(self.gen_topk),
+                "top_p": float(self.gen_topp),
+                "repetition_penalty": float(self.gen_rep_penalty),
+                "frequency_penalty": float(self.gen_freq_penalty),
             }
-            use_att_mask = self.llm_models[self.selected_llm].get("att_mask", False)
-            if use_att_mask:
-                attention_mask = np.ones_like(input_ids, dtype=np.int64)
-            position_ids = np.tile(np.arange(0, input_ids.shape[-1]), (batch_size, 1))
-            max_new_tokens = int(self.gen_max_tokens)
-            #generated_tokens = input_ids
-            for i in range(max_new_tokens):
-                if use_att_mask:
-                    logits, *present_key_values = self.decoder_session.run(None, dict(
-                        input_ids=input_ids,
-                        attention_mask=attention_mask,
-                        position_ids=position_ids,
-                        **past_key_values,
-                    ))
-                else:
-                    logits, *present_key_values = self.decoder_session.run(None, dict(
-                        input_ids=input_ids,
-                        position_ids=position_ids,
-                        **past_key_values,
-                    ))
-
-                ## Update values for next generation loop
-                #input_ids = np.argmax(logits[:, -1], axis=-1, keepdims=True)
-                if self.use_greedy:
-                    input_ids = np.argmax(logits[:, -1, :], axis=-1, keepdims=True).astype(np.int64)
-                else:
-                    input_ids = self.sample_logits(
-                        logits[:, -1, :],
-                        temperature=float(self.gen_temp),
-                        top_p=float(self.gen_topp),
-                        top_k=int(self.gen_topk),
-                    )
-                if use_att_mask:
-                    attention_mask = np.concatenate([attention_mask, np.ones_like(input_ids, dtype=np.int64)], axis=-1)
-                position_ids = position_ids[:, -1:] + 1
-                for j, key in enumerate(past_key_values):
-                    past_key_values[key] = present_key_values[j]
-
-                #generated_tokens = np.concatenate([generated_tokens, input_ids], axis=-1)
-                if np.isin(input_ids, self.eos_token_ids).any() or self.stop:
-                    break
-
-                ## (Optional) Streaming (use tokenizer.decode)
-                txt_update = self.tokenizer.decode(input_ids[0], skip_special_tokens=True)
-                if txt_update and not self.stop:
-                    final_txt += str(txt_update)
-                    Clock.schedule_once(lambda dt: self.update_text_stream(txt_update))
-                    if len(final_txt) > 20 and final_txt.endswith(".."):
-                        break
+            pending_txt = ""
+            last_flush = time.monotonic()
+            ## Streaming: complete text only, coalesced into UI updates
+            for txt_update in self.engine.stream(
+                messages, int(self.gen_max_tokens), sample_kw,
+                greedy=self.use_greedy, doc_qa=doc_qa, cancel_token=token,
+            ):
+                final_txt += txt_update
+                pending_txt += txt_update
+                if time.monotonic() - last_flush >= STREAM_FLUSH_SECS and not token.cancelled:
+                    Clock.schedule_once(lambda dt, txt=pending_txt: self.update_text_stream(txt, token))
+                    pending_txt = ""
+                    last_flush = time.monotonic()
+            if pending_txt and not token.cancelled:
+                Clock.schedule_once(lambda dt, txt=pending_txt: self.update_text_stream(txt, token))
             # final result
             final_result["content"] = final_txt
             final_result["role"] = "assistant"
@@ -1240,8 +1162,7 @@ class OnLlmApp(MDApp):
             print(f"Chat error: {e}")
             final_result["content"] = f"**Error** with LLM: {e}"
             final_result["role"] = "error"
-        if not self.stop:
-            Clock.schedule_once(lambda dt: self.final_llm_result(final_result))
+        return final_result
 
     def popup_delete_model(self, model=""):
         buttons = [
@@ -1269,6 +1190,7 @@ class OnLlmApp(MDApp):
             delete_path = os.path.join(self.model_dir, self.to_delete_model)
             try:
                 import shutil
+                SESSION_POOL.release(delete_path) # a re-download must not get the old session back
                 shutil.rmtree(delete_path)
                 self.show_toast_msg(f"Deleted all files of {self.to_delete_model}")
             except Exception as e:
@@ -1297,7 +1219,10 @@ class OnLlmApp(MDApp):
     def go_to_chat_screen(self):
         self.root.current = "chatbot_screen"
 
-    def update_text_stream(self, txt_update):
+    def update_text_stream(self, txt_update, token=None):
+        # a stopped answer must not write into the next one
+        if token is not None and token.cancelled:
+            return
         if self.tmp_txt:
             self.tmp_txt.text = self.tmp_txt.text + txt_update
 
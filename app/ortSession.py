@@ -0,0 +1,324 @@
+import os
+import gc
+import json
+import hashlib
+import platform
+import threading
+import weakref
+from collections import OrderedDict
+import onnxruntime as ort
+
+GRAPH_OPT_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+# session settings per device class, picked by select_profile (thread counts are capped by the cpu count)
+# "external_data" keeps the weights of the cached graph in a memory-mapped file, but the CPU provider still
+# copies the MatMul weights into its own packed layout. "prepacking": False leaves them in the mapped file
+# (~50 MB less anonymous memory for 50 MB of int8 weights) but the quantized matmuls ran 5-7x slower in
+# our measurements, so it is only set from a model config ("session": {"prepacking": false}).
+SESSION_PROFILES = {
+    # small phones: few threads, no memory pattern/arena so the memory is given back between runs
+    "low": {
+        "intra_op_threads": 2,
+        "inter_op_threads": 1,
+        "graph_opt": "extended",
+        "mem_pattern": False,
+        "cpu_arena": False,
+        "xnnpack_threads": 2,
+        "spinning": False,
+        "save_optimized": True,
+        "external_data": True,
+        "prepacking": True,
+    },
+    # usual phones (4 big cores) & small laptops
+    "mid": {
+        "intra_op_threads": 4,
+        "inter_op_threads": 1,
+        "graph_opt": "all",
+        "mem_pattern": True,
+        "cpu_arena": True,
+        "xnnpack_threads": 4,
+        "spinning": False,
+        "save_optimized": True,
+        "external_data": True,
+        "prepacking": True,
+    },
+    "high": {
+        "intra_op_threads": 8,
+        "inter_op_threads": 2,
+        "graph_opt": "all",
+        "mem_pattern": True,
+        "cpu_arena": True,
+        "xnnpack_threads": 4,
+        "spinning": True,
+        "save_optimized": True,
+        "external_data": True,
+        "prepacking": True,
+    },
+}
+
+# ================== DEVICE CLASS ==================
+def resident_mb():
+    """ Resident memory of this process in MB (linux/android), None if unknown """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) // 1024
+    except Exception:
+        pass
+    return None
+
+def available_ram_mb():
+    """ Available memory (MemAvailable on linux/android, else the total memory), None if unknown """
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except Exception:
+        pass
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // (1024 * 1024)
+    except Exception:
+        return None
+
+def select_profile(cpu_count=None, ram_mb=None):
+    cpu_count = cpu_count or os.cpu_count() or 1
+    if ram_mb is None:
+        ram_mb = available_ram_mb()
+    if cpu_count <= 4 or (ram_mb is not None and ram_mb < 3072):
+        return "low"
+    if cpu_count <= 8 or (ram_mb is not None and ram_mb < 8192):
+        return "mid"
+    return "high"
+
+def resolve_profile(overrides=None):
+    """
+    Profile settings for this device. `overrides` is the "session" entry of the model config,
+    it can name a profile ({"profile": "low"}) and/or set single values ({"intra_op_threads": 3}).
+    """
+    overrides = dict(overrides or {})
+    name = overrides.pop("profile", None) or select_profile()
+    if name not in SESSION_PROFILES:
+        print(f"Unknown session profile {name}, using auto selection")
+        name = select_profile()
+    profile = dict(SESSION_PROFILES[name], **overrides)
+    cpu_count = os.cpu_count() or 1
+    for key in ("intra_op_threads", "inter_op_threads", "xnnpack_threads"):
+        profile[key] = max(1, min(int(profile[key]), cpu_count))
+    profile["name"] = name
+    return profile
+
+# ================== SESSIONS ==================
+def session_options(profile):
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = profile["intra_op_threads"]
+    options.inter_op_num_threads = profile["inter_op_threads"]
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.graph_optimization_level = GRAPH_OPT_LEVELS.get(profile["graph_opt"], GRAPH_OPT_LEVELS["all"])
+    options.enable_mem_pattern = bool(profile["mem_pattern"])
+    options.enable_cpu_mem_arena = bool(profile["cpu_arena"])
+    options.add_session_config_entry("session.intra_op.allow_spinning", "1" if profile["spinning"] else "0")
+    if not profile.get("prepacking", True):
+        options.add_session_config_entry("session.disable_prepacking", "1")
+    return options
+
+def provider_list(providers, profile):
+    """ The providers with their options (XNNPACK gets its own thread pool size) """
+    out = []
+    for provider in providers:
+        if provider == "XnnpackExecutionProvider":
+            out.append((provider, {"intra_op_num_threads": str(profile["xnnpack_threads"])}))
+        else:
+            out.append(provider)
+    return out
+
+def saved_opt_level(profile):
+    """ Level of the saved optimized graph: the layout changes of "all" are tied to the CPU provider """
+    level = profile["graph_opt"] if profile["graph_opt"] in GRAPH_OPT_LEVELS else "all"
+    return "extended" if level == "all" else level
+
+def cache_key(model_path, profile):
+    """ Changes with the model file, the onnxruntime version, the cpu & the options shaping the saved graph """
+    model_stat = os.stat(model_path)
+    info = {
+        "ort": ort.__version__,
+        "machine": platform.machine(),
+        "graph_opt": saved_opt_level(profile),
+        "external_data": bool(profile.get("external_data")),
+        "model": [model_stat.st_size, int(model_stat.st_mtime)],
+    }
+    return hashlib.sha1(json.dumps(info, sort_keys=True).encode()).hexdigest()[:16]
+
+def data_path(optimized_path):
+    """ External weights file of an optimized graph """
+    return f"{os.path.splitext(optimized_path)[0]}.data"
+
+def remove_cached(optimized_path):
+    for path in (optimized_path, f"{optimized_path}.tmp", data_path(optimized_path)):
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            print(f"Could not remove {path}: {e}")
+
+def optimize_model(model_path, optimized_path, profile):
+    """
+    Saves the optimized graph of the model with a CPU only session, the nodes compiled by other
+    providers (XNNPACK) can not be serialized. With "external_data" the weights go to a separate
+    .data file, which onnxruntime memory-maps when loading (the weights it prepacks are still copied).
+    """
+    options = session_options(profile)
+    options.graph_optimization_level = GRAPH_OPT_LEVELS[saved_opt_level(profile)]
+    tmp_path = f"{optimized_path}.tmp"
+    options.optimized_model_filepath = tmp_path
+    if profile.get("external_data"):
+        options.add_session_config_entry("session.optimized_model_external_initializers_file_name", os.path.basename(data_path(optimized_path)))
+        options.add_session_config_entry("session.optimized_model_external_initializers_min_size_in_bytes", "1024")
+    try:
+        ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        os.replace(tmp_path, optimized_path)
+        return True
+    except Exception as e:
+        print(f"Could not save the optimized model: {e}")
+        remove_cached(optimized_path)
+        return False
+
+def cached_model(model_path, profile, cache_dir):
+    """ Path of the optimized graph in `cache_dir` (made if missing, older ones are removed), None on failure """
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    cached_path = os.path.join(cache_dir, f"{name}.{cache_key(model_path, profile)}.onnx")
+    if os.path.exists(cached_path):
+        print(f"Using the cached optimized graph {cached_path}")
+        return cached_path
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for file_name in os.listdir(cache_dir):
+            if file_name.startswith(f"{name}.") and file_name.endswith((".onnx", ".data", ".tmp")):
+                os.remove(os.path.join(cache_dir, file_name)) # stale key
+    except OSError as e:
+        print(f"Graph cache is not writable, using the original model: {e}")
+        return None
+    if optimize_model(model_path, cached_path, profile):
+        print(f"Saved the optimized graph to {cached_path}")
+        return cached_path
+    return None
+
+def make_session(model_path, providers, profile, cache_dir=None):
+    """
+    InferenceSession with the profile settings. With a `cache_dir` (& "save_optimized" in the profile) the
+    optimized graph is cached there & later loads skip the graph optimizations. A cached graph which
+    fails to load is dropped & the original model is used.
+    """
+    providers = provider_list(providers, profile)
+    if cache_dir and profile.get("save_optimized"):
+        cached_path = cached_model(model_path, profile, cache_dir)
+        if cached_path:
+            options = session_options(profile)
+            options.graph_optimization_level = GRAPH_OPT_LEVELS["disable"]
+            try:
+                return ort.InferenceSession(cached_path, sess_options=options, providers=providers)
+            except Exception as e:
+                print(f"Could not load the cached graph, using the original model: {e}")
+                remove_cached(cached_path)
+    return ort.InferenceSession(model_path, sess_options=session_options(profile), providers=providers)
+
+# ================== SESSION POOL ==================
+def default_budget_mb():
+    """ ONLLM_SESSION_POOL_MB if set, else half of the available memory """
+    env_budget = os.environ.get("ONLLM_SESSION_POOL_MB")
+    if env_budget:
+        return int(env_budget)
+    ram_mb = available_ram_mb()
+    return ram_mb // 2 if ram_mb else 1024
+
+class SessionPool:
+    """
+    Process-wide cache of sessions keyed by model & options, shared by the chat models & the embedder.
+    The size of a session is taken from its model file. The pool holds the recently used sessions, before
+    a new session is loaded the least recently used ones are dropped until it fits in `budget_mb`.
+    A dropped (or released) session is only tracked weakly: it is freed once its users let it go, until
+    then it still counts in the budget & a `get` for it hands the same session back instead of a copy.
+    A model bigger than the budget still loads alone.
+    """
+
+    def __init__(self, budget_mb=None) -> None:
+        self.budget_mb = budget_mb
+        self.lock = threading.RLock()
+        self.sessions = OrderedDict() # key: session held by the pool, least recently used first
+        self.dropped = weakref.WeakValueDictionary() # key: session dropped by the pool, alive while in use
+        self.info = {} # key: (model path, size_mb) of every session above
+
+    def make_key(self, model_path, providers, profile, cache_dir):
+        # the file size & time make a re-downloaded model at the same path a new session
+        model_stat = os.stat(model_path)
+        return json.dumps([
+            os.path.abspath(model_path), model_stat.st_size, int(model_stat.st_mtime), providers, profile, cache_dir,
+        ], sort_keys=True)
+
+    def used_mb(self):
+        for key in list(self.info):
+            if key not in self.sessions and key not in self.dropped:
+                del self.info[key] # freed
+        return sum(size for _, size in self.info.values())
+
+    def get(self, model_path, providers, profile, cache_dir=None):
+        with self.lock:
+            if self.budget_mb is None:
+                self.budget_mb = default_budget_mb()
+            key = self.make_key(model_path, providers, profile, cache_dir)
+            session = self.sessions.get(key) or self.dropped.get(key)
+            if session is not None:
+                self.dropped.pop(key, None)
+                self.sessions[key] = session
+                self.sessions.move_to_end(key)
+                return session
+            size_mb = os.path.getsize(model_path) // (1024 * 1024)
+            self.evict(size_mb)
+            session = make_session(model_path, providers, profile, cache_dir)
+            self.sessions[key] = session
+            self.info[key] = (os.path.abspath(model_path), size_mb)
+            print(f"Session pool: {len(self.sessions)} sessions, {self.used_mb()}/{self.budget_mb} MB")
+            return session
+
+    def drop(self, key):
+        self.dropped[key] = self.sessions.pop(key)
+        print(f"Session pool: dropped {self.info[key][0]}")
+
+    def evict(self, needed_mb=0):
+        """ Drops the least recently used sessions until `needed_mb` more fits in the budget """
+        dropped = False
+        while self.sessions and self.used_mb() + needed_mb > self.budget_mb:
+            self.drop(next(iter(self.sessions)))
+            dropped = True
+            gc.collect()
+        if dropped and self.used_mb() + needed_mb > self.budget_mb:
+            print(f"Session pool: {self.used_mb()} MB still in use")
+
+    def release(self, path):
+        """ Drops the sessions of a model file (or of every model under a folder), freed once unused """
+        path = os.path.abspath(path)
+        with self.lock:
+            for key in list(self.sessions):
+                model_path = self.info[key][0]
+                if model_path == path or model_path.startswith(path + os.sep):
+                    self.drop(key)
+            gc.collect()
+
+    def set_budget(self, budget_mb):
+        with self.lock:
+            self.budget_mb = budget_mb
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.sessions):
+                self.drop(key)
+            gc.collect()
+
+SESSION_POOL = SessionPool()
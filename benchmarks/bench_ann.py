@@ -0,0 +1,69 @@
+"""
+Exact (brute force) vs IVF approximate search over unit vectors, like the RAG library matrix.
+
+    python benchmarks/bench_ann.py --rows 50000 --dim 384
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from annIndex import IvfIndex
+
+
+def make_corpus(rows, dim, clusters, rng):
+    # clustered data is closer to real chunk embeddings than uniform noise
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    data = centers[rng.integers(0, clusters, rows)] + 0.5 * rng.standard_normal((rows, dim)).astype(np.float32)
+    return data / np.linalg.norm(data, axis=1, keepdims=True)
+
+
+def exact_top_k(matrix, query, top_k):
+    sims = matrix @ query
+    top = np.argpartition(-sims, top_k - 1)[:top_k]
+    return top[np.argsort(-sims[top])]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    matrix = make_corpus(args.rows, args.dim, max(args.rows // 500, 8), rng)
+    row_ids = np.arange(1, args.rows + 1, dtype=np.int64)
+    # queries close to the corpus rows, the way questions land near their chunks
+    queries = matrix[rng.integers(0, args.rows, args.queries)] + 0.3 * rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index = IvfIndex(os.path.join(tmp_dir, "bench.ivf.npz"))
+        start = time.perf_counter()
+        index.sync(row_ids, matrix, min_rows=0)
+        print(f"rows: {args.rows}, dim: {args.dim}, lists: {len(index.centroids)}, build: {time.perf_counter() - start:.2f}s")
+
+        start = time.perf_counter()
+        truth = [exact_top_k(matrix, q, args.top_k) for q in queries]
+        exact_ms = (time.perf_counter() - start) * 1000 / args.queries
+        print(f"{'exact':>10}: {exact_ms:8.3f} ms/query, recall@{args.top_k}: 1.000")
+
+        for nprobe in args.nprobe:
+            hits = 0
+            start = time.perf_counter()
+            results = [index.search(matrix, q, args.top_k, nprobe=nprobe)[0] for q in queries]
+            ann_ms = (time.perf_counter() - start) * 1000 / args.queries
+            for found, expected in zip(results, truth):
+                hits += len(np.intersect1d(found, expected))
+            recall = hits / (args.top_k * args.queries)
+            print(f"{'nprobe ' + str(nprobe):>10}: {ann_ms:8.3f} ms/query, recall@{args.top_k}: {recall:.3f}, speedup: {exact_ms / ann_ms:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+The Sampler of llmEngine vs the previous sample_logits of main.py, per generated token.
+
+    python benchmarks/bench_sampler.py --vocab 49152 262144
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from llmEngine import Sampler
+
+
+def legacy_sample_logits(logits, temperature=0.2, top_p=0.9, top_k=40):
+    # copy of OnLlmApp.sample_logits before the Sampler
+    logits = logits.astype(np.float64)
+    logits = logits / max(temperature, 1e-5)
+
+    exp_logits = np.exp(logits - np.max(logits, axis=-1, keepdims=True))
+    probs = exp_logits / np.sum(exp_logits, axis=-1, keepdims=True)
+
+    if top_k and top_k > 0:
+        idx = np.argpartition(probs[0], -top_k)[-top_k:]
+        mask = np.zeros_like(probs[0], dtype=bool)
+        mask[idx] = True
+        probs[0][~mask] = 0.0
+        probs = probs / (np.sum(probs, axis=-1, keepdims=True) + 1e-12)
+
+    sorted_indices = np.argsort(probs[0])[::-1]
+    sorted_probs = probs[0, sorted_indices]
+    cumulative_probs = np.cumsum(sorted_probs)
+
+    cutoff = np.where(cumulative_probs > top_p)[0]
+    cutoff = cutoff[0] + 1 if len(cutoff) > 0 else len(sorted_probs)
+
+    probs[0, sorted_indices[cutoff:]] = 0.0
+    probs = probs / (np.sum(probs, axis=-1, keepdims=True) + 1e-12)
+
+    next_token = np.random.choice(len(probs[0]), p=probs[0])
+    return np.array([[next_token]], dtype=np.int64)
+
+
+def time_per_call(fn, logits_rows):
+    start = time.perf_counter()
+    for logits in logits_rows:
+        fn(logits)
+    return (time.perf_counter() - start) / len(logits_rows) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab", type=int, nargs="+", default=[49152, 262144])
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument("--top-p", type=float, default=0.85)
+    parser.add_argument("--temperature", type=float, default=0.15)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    params = dict(temperature=args.temperature, top_p=args.top_p, top_k=args.top_k)
+    print(f"{'vocab':>8} {'legacy ms':>10} {'sampler ms':>11} {'speedup':>8}")
+    for vocab in args.vocab:
+        # logits like the model output: (1, vocab) float32 with a few strong candidates
+        logits_rows = [(rng.standard_normal((1, vocab)) * 3).astype(np.float32) for _ in range(args.steps)]
+        sampler = Sampler(seed=0)
+
+        # both keep the same candidate set
+        ids, _ = sampler.distribution(logits_rows[0], **params)
+        scaled = logits_rows[0][0].astype(np.float64) / args.temperature
+        top = np.argsort(-scaled)[:args.top_k]
+        probs = np.exp(scaled[top] - scaled[top].max())
+        cum = np.cumsum(probs / probs.sum())
+        keep = min(int(np.searchsorted(cum, args.top_p, side="right")) + 1, len(top))
+        assert set(ids.tolist()) == set(top[:keep].tolist()), "candidate sets differ"
+
+        legacy_ms = time_per_call(lambda x: legacy_sample_logits(x, **params), logits_rows)
+        sampler_ms = time_per_call(lambda x: sampler.sample(x, **params), logits_rows)
+        print(f"{vocab:>8} {legacy_ms:>10.3f} {sampler_ms:>11.3f} {legacy_ms / sampler_ms:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()